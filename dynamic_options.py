@@ -20,6 +20,12 @@ DYNAMIC_OPTIONS = {
     
     'num_top_leaderboard': 10,
     
+    'leaderboard_page_size': 20, #players per full_leaderboard page (pages must fit in one discord message)
+    
+    'record_page_size': 10, #opponents per page of the record command (pages must fit in one discord message)
+    
+    'ongoing_page_size': 10, #challenges on one page of !ongoing
+    
     'about_text': \
 '''Server specific about text has not been filled out.''',
 
@@ -32,9 +38,49 @@ DYNAMIC_OPTIONS = {
     
     'starting_rating': 2000,
     
+    'storage_backend': 'pickle', #'pickle' keeps stats in memory, 'sqlite' (laddermanager.db) suits very large ladders
+    
+    'snapshot_interval': 50, #reported matches between full snapshots of player stats
+    
+    'save_delay': 5, #seconds that changes to teams and challenges are batched before being saved
+    
     'separate_1v1_mmr': False,
     
     'enforce_equal_size_teams': False,
     
-    'command_symbol': '!'
+    'command_symbol': '!',
+    
+    'coalesce_window': 0.25, #seconds replies to the same channel are held so they can be sent as one message
+    
+    'channel_messages_per_second': 1, #sustained rate of messages the bot sends to one channel
+    
+    'channel_message_burst': 5, #messages the bot can send to one channel at once before being slowed to the rate above
+    
+    'admin_ids': [], #user ids allowed to use admin commands (!metrics) besides server administrators
+    
+    'metrics_file': 'laddermanager_metrics.prom', #prometheus text file with command latencies, '' to disable
+    
+    'metrics_interval': 60, #seconds between rewrites of metrics_file
+    
+    'message_trace_file': '', #if set, every message the bot sees is appended here for ladder_manager_replay.py
+    
+    'message_trace_interval': 1, #seconds that traced messages are buffered before being appended (on an executor)
+    
+    'ladders_directory': 'ladders', #each guild's ladder files are kept in ladders_directory/<guild id>/
+    
+    'default_guild_id': None, #guild whose ladder (and DMs) stays in the bot's folder; if None a ladder left there by an older version moves to the bot's only guild
+    
+    'shard_count': None, #shards the bot runs on, None lets discord decide
+    
+    'shard_ids': None, #shards this process runs (list of ids) when the bot is split over several processes, None for all
+    
+    'max_loaded_ladders': 100, #most guild ladders kept in memory, the least recently used is saved and unloaded past it (0 for no limit)
+    
+    'ladder_idle_timeout': 3600, #seconds after which an unused guild ladder is saved and unloaded, 0 to keep it loaded
+    
+    'challenge_timeout': 86400, #seconds a challenge can wait to be accepted before it's dropped, 0 to keep it until cancelled
+    
+    'accepted_challenge_timeout': 259200, #seconds an accepted challenge can wait to be reported before it's dropped, 0 to keep it until reported
+    
+    'team_invite_timeout': 86400 #seconds a team invite can wait to be accepted before it's withdrawn, 0 to keep it
 }
\ No newline at end of file
@@ -1,6 +1,17 @@
 import re
+from typing import TYPE_CHECKING
+
 import discord
 
+try:
+    import numpy
+except ImportError: #only needed to speed up mmr_calculator_batch
+    numpy = None
+
+if TYPE_CHECKING: #annotations only, ladder_manager_challenges imports this module
+    from ladder_manager_storage import PlayerStatsRepository
+    from ladder_manager_challenges import Challenge
+
 WIN = 1
 LOSS = -1 #important for these to stay the same, see mmr_calculator function
 
@@ -15,10 +26,36 @@ class DirectedMessage():
 
 
 class Team():
-    """Represents a team."""
+    """Represents a team. Its identity is the frozenset of its members' ids (key), built once
+        with its hash and only rebuilt when someone is invited or removed, so comparing and
+        hashing teams doesn't build sets."""
     def __init__(self, first : [int, str],*args : (int, str)):
         self._members = {p_id:[False, name] for p_id, name in args}
         self._members[first[0]] = [True, first[1]]
+        self.id = None #set by TeamRegistry.add
+        self._changed()
+    
+    def __getstate__(self):
+        return {'_members': self._members, 'id': self.id}
+    
+    def __setstate__(self, state):
+        self._members = state['_members']
+        self.id = state.get('id') #teams saved before they had ids get one from TeamRegistry
+        self._changed()
+    
+    def _changed(self) -> None:
+        self._key = None
+        self._hash = None
+    
+    @property
+    def key(self) -> frozenset:
+        if self._key is None:
+            self._key = frozenset(self._members)
+            self._hash = hash(self._key)
+        return self._key
+    
+    def __hash__(self):
+        return self._hash if self._key is not None else hash(self.key)
 
     def __bool__(self):
         return len(self._members) >= 2
@@ -38,7 +75,7 @@ class Team():
         return item in self._members
     
     def __eq__(self, other):
-        return set(self._members.keys()) == set(other._members.keys())
+        return self is other or (hash(self) == hash(other) and self.key == other.key)
     
     def __len__(self):
         return len(self._members)
@@ -55,14 +92,62 @@ class Team():
     def get_members_dict(self) -> dict:
         return self._members
     
+    def rating(self, player_stats : 'PlayerStatsRepository') -> int:
+        """The members' average rating on a ladder (every member needs an account there)."""
+        return sum(player_stats.get(player)['rating'] for player in self._members) // len(self._members)
+    
     def invite(self, p_id : int, name : str) -> None:
         self._members[p_id] = [False, name]
+        self._changed()
     
     def update(self, p_id : int) -> None:
         self._members[p_id][0] = True
         
     def remove(self, p_id : int) -> None:
         del self._members[p_id]
+        self._changed()
+
+
+class TeamRegistry():
+    """Teams by member (members, which is the ladder's self.teams) and by team id.
+        Players who aren't on a team play as a team of one that isn't registered."""
+    def __init__(self, members : {int: Team}):
+        self.members = members
+        self.by_id = {} #team id: Team
+        self._next_id = 1
+        teams = {id(team): team for team in members.values()}.values() #the same team is under each member
+        #teams saved before they had ids get new ones after the saved ones
+        for team in sorted(teams, key = lambda team: (team.id or float('inf'), min(team.key))):
+            self.add(team)
+    
+    def __len__(self):
+        return len(self.by_id)
+    
+    def add(self, team : Team) -> int:
+        """Registers a team (again, after invites) under its id and each of its members."""
+        if team.id is None:
+            team.id = self._next_id
+        self._next_id = max(self._next_id, team.id + 1)
+        self.by_id[team.id] = team
+        for player in team.get_players():
+            self.members[player] = team
+        return team.id
+    
+    def remove_member(self, p_id : int) -> Team:
+        """Takes a player off their team, dropping the team once nobody is left on it."""
+        team = self.members.pop(p_id)
+        team.remove(p_id)
+        if not len(team):
+            self.by_id.pop(team.id, None)
+        return team
+    
+    def get(self, team_id : int) -> Team:
+        return self.by_id.get(team_id)
+    
+    def on_team(self, p_id : int) -> bool:
+        """Whether a player is on (or invited to) a team with someone else."""
+        team = self.members.get(p_id)
+        return team is not None and len(team) >= 2
         
 
 def other_player(players : (int, int), player : int):
@@ -78,20 +163,80 @@ def mmr_calculator(base_rating_change : int, prediction_difference : int,
         else:
             p2wins += amount
         
-        for _ in range(amount):
-            
-            rating_difference = abs(player1mmr - player2mmr)//prediction_difference
-            
-            if rating_difference > base_rating_change: rating_difference = base_rating_change #make sure there isn't negative mmr change
-            
-            player_favored = 1 if player1mmr >= player2mmr else -1
-            
-            mmr_change = (base_rating_change + rating_difference * player_favored * -outcome) + 1
-        
-            player1mmr += mmr_change * outcome
-            player2mmr += mmr_change * -outcome
+        player1mmr, player2mmr = _mmr_set(base_rating_change, prediction_difference,
+                                          player1mmr, player2mmr, outcome, amount)
     
     return (player1mmr, player2mmr, p1wins, p2wins)
+
+
+def _mmr_set(base_rating_change : int, prediction_difference : int,
+             player1mmr : int, player2mmr : int, outcome : WIN or LOSS, amount : int) -> (int, int):
+    """Applies amount games with the same outcome.
+    Each game's mmr change only depends on which player is favored and on the clamped
+    rating_difference, so instead of looping per game this jumps over every run of games
+    where both stay the same (once rating_difference is clamped that's the rest of the set)."""
+    while amount > 0:
+        rating_difference = abs(player1mmr - player2mmr)//prediction_difference
+        
+        if rating_difference > base_rating_change: rating_difference = base_rating_change #make sure there isn't negative mmr change
+        
+        player_favored = 1 if player1mmr >= player2mmr else -1
+        
+        mmr_change = (base_rating_change + rating_difference * player_favored * -outcome) + 1
+        
+        games = 1
+        if amount > 1 and (rating_difference == base_rating_change or 2 * mmr_change < prediction_difference):
+            games = _mmr_run_length(base_rating_change, prediction_difference, player1mmr - player2mmr,
+                                    rating_difference, player_favored, 2 * mmr_change * outcome, amount)
+        
+        player1mmr += mmr_change * outcome * games
+        player2mmr += mmr_change * -outcome * games
+        amount -= games
+    
+    return (player1mmr, player2mmr)
+
+
+def _mmr_run_length(base_rating_change : int, prediction_difference : int, difference : int,
+                    rating_difference : int, player_favored : int, step : int, amount : int) -> int:
+    """Returns how many of the next amount games keep the same player_favored and rating_difference,
+    given player1mmr - player2mmr (difference) and how much each game changes it (step, never 0)."""
+    low = rating_difference * prediction_difference
+    high = None if rating_difference == base_rating_change else low + prediction_difference - 1
+    if player_favored == -1:
+        low, high = (None if high is None else -high), min(-low, -1)
+    
+    if step > 0:
+        return amount if high is None else min(amount, (high - difference)//step + 1)
+    return amount if low is None else min(amount, (difference - low)//-step + 1)
+
+
+def mmr_calculator_batch(base_rating_change : int, prediction_difference : int,
+                         player1mmrs : [int], player2mmrs : [int], match_sets_list : [[(WIN or LOSS, int)]]):
+    """mmr_calculator for many matches at once (bulk replays and imports).
+    Returns lists (player1mmrs, player2mmrs, p1wins, p2wins) with one entry per match.
+    Uses NumPy to play game n of every match in one vectorized step if it's installed."""
+    if numpy is None:
+        results = [mmr_calculator(base_rating_change, prediction_difference, p1, p2, sets)
+                   for p1, p2, sets in zip(player1mmrs, player2mmrs, match_sets_list)]
+        return tuple(list(column) for column in zip(*results)) if results else ([], [], [], [])
+    
+    games = [[outcome for outcome, amount in sets for _ in range(amount)] for sets in match_sets_list]
+    outcomes = numpy.zeros((len(games), max(map(len, games), default = 0)), dtype = numpy.int64) #0 pads shorter matches
+    for match, match_games in enumerate(games):
+        outcomes[match, :len(match_games)] = match_games
+    
+    player1 = numpy.array(player1mmrs, dtype = numpy.int64)
+    player2 = numpy.array(player2mmrs, dtype = numpy.int64)
+    for outcome in outcomes.T:
+        rating_difference = numpy.minimum(numpy.abs(player1 - player2)//prediction_difference, base_rating_change)
+        player_favored = numpy.where(player1 >= player2, 1, -1)
+        mmr_change = (base_rating_change + rating_difference * player_favored * -outcome) + 1
+        player1 += mmr_change * outcome
+        player2 -= mmr_change * outcome
+    
+    p1wins = (outcomes == WIN).sum(axis = 1)
+    p2wins = (outcomes == LOSS).sum(axis = 1)
+    return (player1.tolist(), player2.tolist(), p1wins.tolist(), p2wins.tolist())
             
 
 class BaseCommands():
@@ -100,19 +245,26 @@ class BaseCommands():
         """Input: id of user.
         Output: user's model."""
         if identity:
-            for user in self.client.users:
-                if user.id == int(identity):
-                    return user
+            return self.user_index.get(int(identity))
+
 
+    def _is_ladder_member(self, user_id : int) -> bool:
+        """Whether a user belongs on this ladder: a member of its guild, or of any server
+        the bot shares for the default ladder without a guild."""
+        if self.guild_id is None:
+            return self._find_user(user_id) is not None
+        guild = self.client.get_guild(self.guild_id)
+        return guild is not None and guild.get_member(user_id) is not None
 
-    def find_user_with_name(self, name):
+
+    def find_user_with_name(self, name, fuzzy = False):
         #need name of user as input, tries to find them
-        for user in self.client.users:
-            try:
-                if user.name.lower() == name.lower():
-                    return user
-            except UnicodeEncodeError:
-                continue
+        #fuzzy also accepts unique prefixes and close spellings of the name
+        if fuzzy:
+            return self.user_index.find_fuzzy(name)
+        users = self.user_index.find_by_name(name)
+        if users:
+            return users[0]
 
             
     def find_channel(self, identity):
@@ -131,15 +283,26 @@ class BaseCommands():
         raise ValueError('Message contained no mentions.')
     
     
+    def _mention_or_name_strip(self, message : str) -> int:
+        """Like _mention_strip, but also accepts a plain user name after the command word."""
+        match = re.search('<@!?([0-9]+)>', message)
+        if match:
+            return int(match.group(1))
+        command_args = message.strip().split(maxsplit = 1)
+        if len(command_args) == 2:
+            user = self.find_user_with_name(command_args[1], fuzzy = True)
+            if user is not None:
+                return user.id
+        return self._mention_strip(message)
+    
+    
     def _mention_strip_mass(self, message : str) -> [int]:
         return [int(num) for num in re.findall('[0-9]+', message)]
 
 
     def _has_account(self, user_id: int) -> bool:
         """Returns whether or not a player has an account in player_stats."""
-        if user_id in self.player_stats:
-            return True
-        return False
+        return self.player_stats.has_account(user_id)
 
 
     def _invalid_user_input(self,
@@ -149,7 +312,46 @@ class BaseCommands():
         return (DirectedMessage(error_message, message.channel),)
     
     
+    def _is_admin(self, user : 'discord.User or discord.Member') -> bool:
+        """Relies on dynamic option: 'admin_ids'. Server administrators count as admins too."""
+        permissions = getattr(user, 'guild_permissions', None) #Users (DMs) have no permissions
+        return user.id in self.dynamic_options['admin_ids'] or bool(permissions and permissions.administrator)
+    
+    
+    def _temporary_data_changed(self) -> None:
+        """Called by commands that change teams or challenges, schedules a save."""
+        self.save_scheduler.mark_dirty()
+    
+    
+    def _expire(self, key : (str, 'Challenge or int')) -> None:
+        """Called by self.expiry (see ladder_manager_expiry) once a challenge or team invite times out."""
+        kind, value = key
+        if kind == 'challenge':
+            self._expire_challenge(value)
+        else:
+            self._expire_team_invite(value)
+    
+    
+    def _restore_expiries(self, deadlines : dict) -> None:
+        """Schedules the saved deadlines of challenges and team invites, the ones saved without
+        a deadline (before they could expire) get a full timeout from now."""
+        for challenge in set(self.challenges.values()):
+            self._schedule_challenge_expiry(challenge, deadlines.get(('challenge', challenge)))
+        for p_id, team in self.teams.items():
+            if p_id in team and not team.get_members_dict()[p_id][0]:
+                self._schedule_invite_expiry(p_id, deadlines.get(('invite', p_id)))
+    
+    
     def _get_player_team(self, p_id : int) -> Team:
-        return self.teams[p_id] if p_id in self.teams else\
-             Team((p_id, self._find_user(p_id).name))
+        """Returns a player's team, or a team of just them if they have none. Teams of one are made
+        once and reused (see _solo_teams) with the player's current name, player_left drops them."""
+        team = self.teams.get(p_id)
+        if team is None:
+            name = self._find_user(p_id).name
+            team = self._solo_teams.get(p_id)
+            if team is None:
+                team = self._solo_teams[p_id] = Team((p_id, name))
+            else:
+                team.get_members_dict()[p_id][1] = name #they may have renamed since
+        return team
     
@@ -0,0 +1,200 @@
+'''Synthetic-load benchmarks: builds a LadderManager against a fake client (see
+ladder_manager_fakes), seeds it with many players and dense head-to-head records
+and times the hot commands plus loading and saving the ladder. Needs no network.
+
+    python ladder_manager_benchmark.py --players 10000 100000 500000 --backend pickle sqlite
+    python ladder_manager_benchmark.py --output new.json --baseline old.json
+
+Every run happens in a temporary directory, the live ladder files are never touched.
+Results (milliseconds per call) are written as JSON; with --baseline the medians are
+compared against an earlier result file so regressions between versions stand out.'''
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import statistics
+
+import ladder_manager_main as main
+from ladder_manager_journal import MatchJournal
+from ladder_manager_storage import PlayerStats
+from ladder_manager_records import HeadToHead
+from ladder_manager_fakes import FakeClient, FakeMessage, FakeUser
+from dynamic_options import DYNAMIC_OPTIONS
+
+MATCH_COMMAND_BATCH = 1000 #messages per match_command sample, a single call is too quick to time alone
+
+
+def seed_snapshot(path : str, players : [int], records_per_player : int, seed : int) -> None:
+    """Writes a general ladder snapshot where every player has played about records_per_player others."""
+    rng = random.Random(seed)
+    player_stats = {player: PlayerStats(rng.randint(600, 1800)) for player in players}
+    head_to_head = HeadToHead()
+    for player in players:
+        for _ in range(records_per_player // 2): #each pairing is a record for both players
+            opponent = rng.choice(players)
+            if opponent == player or head_to_head.get(player, opponent):
+                continue
+            wins, losses = rng.randint(0, 10), rng.randint(0, 10)
+            head_to_head.add(player, opponent, wins, losses)
+            for user_id, won, lost in ((player, wins, losses), (opponent, losses, wins)):
+                player_stats[user_id].wins += won
+                player_stats[user_id].losses += lost
+    MatchJournal(path, path + '.journal', 0).snapshot([player_stats, {}, {}, {}, head_to_head.pairs, {}])
+
+
+def summarize(samples : [float]) -> dict:
+    samples = sorted(sample * 1000 for sample in samples)
+    return {'calls': len(samples),
+            'mean_ms': statistics.mean(samples),
+            'median_ms': statistics.median(samples),
+            'p95_ms': samples[min(len(samples) - 1, int(0.95 * len(samples)))],
+            'min_ms': samples[0],
+            'max_ms': samples[-1]}
+
+
+def timed(function, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+class Benchmark():
+    """One seeded guild ladder on one storage backend, run in the current directory."""
+    def __init__(self, backend : str, players : int, records_per_player : int, iterations : int, seed : int):
+        self.backend = backend
+        self.iterations = iterations
+        self.rng = random.Random(seed)
+        self.client = FakeClient()
+        self.guild = self.client.add_guild('benchmark')
+        self.channel = self.client.add_channel(self.guild, 'ladder')
+        self.users = self.client.add_users(players, self.guild, seed = seed)
+        self.results = {}
+
+        DYNAMIC_OPTIONS['storage_backend'] = backend
+        DYNAMIC_OPTIONS['metrics_file'] = ''
+        self.ladders = main.setup(self.client)
+        directory = self.ladders.directory_of(self.guild.id)
+        os.makedirs(directory, exist_ok = True)
+        seed_snapshot(os.path.join(directory, 'laddermanager.pkl'), [user.id for user in self.users], records_per_player, seed)
+        start = time.perf_counter()
+        self.ladder = self.ladders.get(self.guild.id) #sqlite imports the seeded pickle here
+        self.results['first_load'] = summarize([time.perf_counter() - start])
+        main.user_index.rebuild()
+        self.ladder.reconcile_player_stats()
+        ranked = self.ladder.player_stats.count()
+        if ranked != players: #timing an empty leaderboard would look fast (eg. a rank index built before the import)
+            raise RuntimeError(f'{backend}: {ranked} of the {players} seeded players are on the leaderboard')
+
+
+    def message(self, author : 'FakeUser', content : str) -> FakeMessage:
+        return FakeMessage(author, content, self.channel)
+
+
+    def time_handler(self, name : str, make_message, before = None) -> None:
+        """Times POSSIBLE_COMMANDS[name] on iterations fresh messages, calling before (untimed) first."""
+        samples = []
+        for _ in range(self.iterations):
+            if before:
+                before()
+            samples.append(timed(main.POSSIBLE_COMMANDS[name], self.ladder, make_message()))
+        self.results[name] = summarize(samples)
+
+
+    def run(self) -> dict:
+        symbol = DYNAMIC_OPTIONS['command_symbol']
+        user = lambda: self.rng.choice(self.users)
+        clear_cache = self.ladder._rendered_leaderboards.clear
+
+        contents = [symbol + command for command in ('leaderboard', 'stats', 'record', 'accept', 'report win 2, loss 1',
+                                                     'full_leaderboard 3', 'play <@100001>', 'ongoing')]
+        contents += ['just chatting', 'gg', 'anyone up for a game?']
+        batch = [self.message(user(), self.rng.choice(contents)) for _ in range(MATCH_COMMAND_BATCH)]
+        self.results['match_command'] = summarize(
+            [timed(lambda: [main.match_command(message) for message in batch]) / MATCH_COMMAND_BATCH
+             for _ in range(self.iterations)])
+
+        self.time_handler('leaderboard', lambda: self.message(user(), symbol + 'leaderboard'), clear_cache)
+        self.results['leaderboard_cold'] = self.results.pop('leaderboard')
+        self.time_handler('leaderboard', lambda: self.message(user(), symbol + 'leaderboard'))
+        self.results['leaderboard_warm'] = self.results.pop('leaderboard')
+        pages = max(1, len(self.users) // DYNAMIC_OPTIONS['leaderboard_page_size'])
+        self.time_handler('full_leaderboard', lambda: self.message(user(), f'{symbol}full_leaderboard {self.rng.randint(1, pages)}'),
+                          clear_cache)
+        self.time_handler('stats_other', lambda: self.message(user(), f'{symbol}stats <@{user().id}>'))
+        self.results['stats_other_mention'] = self.results.pop('stats_other')
+        self.time_handler('stats_other', lambda: self.message(user(), f'{symbol}stats {user().name}'))
+        self.results['stats_other_name'] = self.results.pop('stats_other')
+        self.time_handler('record_self', lambda: self.message(user(), symbol + 'record'))
+
+        challengers = []
+        def challenge():
+            challenger, challenged = self.rng.sample(self.users, 2)
+            main.POSSIBLE_COMMANDS['challenge'](self.ladder, self.message(challenger, f'{symbol}play <@{challenged.id}>'))
+            main.POSSIBLE_COMMANDS['accept_challenge'](self.ladder, self.message(challenged, symbol + 'accept'))
+            challengers.append(challenger)
+        self.time_handler('report_challenge', lambda: self.message(challengers.pop(), f'{symbol}report win 2, loss 1'),
+                          challenge)
+
+        loads, saves = [], []
+        for _ in range(max(1, self.iterations // 10)):
+            saves.append(timed(self.ladder.storage.close))
+            start = time.perf_counter()
+            self.ladders = main.setup(self.client)
+            self.ladder = self.ladders.get(self.guild.id)
+            loads.append(time.perf_counter() - start)
+        self.results['save'] = summarize(saves)
+        self.results['load'] = summarize(loads)
+        self.ladder.storage.close()
+        return self.results
+
+
+def compare(results : [dict], baseline : [dict]) -> None:
+    """Prints the median of every operation next to the baseline's."""
+    old = {(result['backend'], result['players'], result['operation']): result for result in baseline}
+    print(f'{"backend":<8}{"players":>9} {"operation":<22}{"median ms":>11}{"baseline":>11}{"ratio":>8}')
+    for result in results:
+        before = old.get((result['backend'], result['players'], result['operation']))
+        if before:
+            ratio = result['median_ms'] / before['median_ms'] if before['median_ms'] else float('inf')
+            print(f'{result["backend"]:<8}{result["players"]:>9} {result["operation"]:<22}'
+                  f'{result["median_ms"]:>11.3f}{before["median_ms"]:>11.3f}{ratio:>7.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Time ladder commands on a large synthetic ladder.')
+    parser.add_argument('--players', type = int, nargs = '+', default = [10000])
+    parser.add_argument('--records', type = int, default = 20, help = 'head-to-head records per player')
+    parser.add_argument('--backend', nargs = '+', default = ['pickle'], choices = ['pickle', 'sqlite'])
+    parser.add_argument('--iterations', type = int, default = 200, help = 'timed calls per command')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', default = 'benchmark_results.json')
+    parser.add_argument('--baseline', help = 'earlier --output file to compare against')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    results = []
+    for backend in args.backend:
+        for players in args.players:
+            with tempfile.TemporaryDirectory() as directory:
+                os.chdir(directory)
+                print(f'{backend}, {players} players...', file = sys.stderr)
+                benchmark = Benchmark(backend, players, args.records, args.iterations, args.seed)
+                for operation, stats in benchmark.run().items():
+                    results.append(dict(backend = backend, players = players, records = args.records,
+                                        operation = operation, **stats))
+                os.chdir(os.path.dirname(output))
+
+    with open(output, 'w') as result_file:
+        json.dump({'version': DYNAMIC_OPTIONS['version'],
+                   'python': platform.python_version(),
+                   'timestamp': time.time(),
+                   'results': results}, result_file, indent = 1)
+    print(f'Wrote {len(results)} results to {output}.')
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            compare(results, json.load(baseline_file)['results'])
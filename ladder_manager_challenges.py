@@ -1,12 +1,42 @@
+import io
 import re
-import pickle
-from collections import defaultdict
+import time
+import itertools
+from typing import TYPE_CHECKING
 
 import discord
 
 import ladder_manager_base as base
 from ladder_manager_base import DirectedMessage
 from ladder_manager_base import Team
+from ladder_manager_metrics import METRICS
+from ladder_manager_history import MAX_SETS
+
+if TYPE_CHECKING: #annotations only
+    from ladder_manager_storage import PlayerStatsRepository
+
+#report grammar, compiled once: sets like "win 2, loss 1" of 1 to 9 games, from the reporting side
+REPORT_WIN = r'win|won|wins|wons'
+REPORT_LOSS = r'loss|lose|lost'
+REPORT_SET = re.compile(f'((?:{REPORT_WIN})|(?:{REPORT_LOSS})) ?([1-9])?')
+REPORT_WIN_OUTCOME = re.compile(REPORT_WIN)
+BULK_REPORT_LINE = re.compile(r'\s*#?([0-9]+)[\s:]+(.*)') #challenge id, then its sets
+BULK_REPORT_MAX_BYTES = 1 << 20
+
+
+def parse_report(text : str) -> [(int, int)]:
+    """Returns the sets in a report, "win 2, loss 1" being [(WIN, 2), (LOSS, 1)].
+    Returns None if there are none or one doesn't say how many games."""
+    sets = REPORT_SET.findall(text.lower())
+    if not sets or not all(amount for _, amount in sets):
+        return None
+    return [(base.WIN if REPORT_WIN_OUTCOME.match(outcome) else base.LOSS, int(amount)) for outcome, amount in sets]
+
+
+def _fit(text : str) -> str:
+    """Cuts a reply down to one discord message."""
+    return text if len(text) <= 1990 else text[:1975] + '\n... (cut short)'
+
 
 class InvalidUserInput(Exception):
     """Called when the user input is invalid."""
@@ -20,6 +50,7 @@ class Challenge():
         self._challenged = team2
         self._teams = (self._challenger, self._challenged)
         self.accepted = False
+        self.id = None #set by ChallengeRegistry.add
     
     def get_challenger_team(self):
         return self._challenger
@@ -53,6 +84,58 @@ class Challenge():
         return (self._challenger, self._challenged) if p_id in self._challenger else (self._challenged, self._challenger)
 
 
+class ChallengeRegistry():
+    """Every ongoing challenge once, by id (self.challenges indexes the same challenges by player).
+        Pending and accepted challenges are kept apart, so !ongoing pages through one kind
+        without looking at the other or at every player's entry."""
+    def __init__(self, challenges : [Challenge] = ()):
+        self.pending = {} #challenge id: Challenge, oldest first
+        self.accepted = {} #challenge id: Challenge, in the order they were accepted
+        self._next_id = 1
+        #challenges saved before they had ids get new ones after the saved ones
+        for challenge in sorted(challenges, key = lambda challenge: (getattr(challenge, 'id', None) or float('inf'),
+                                                                     min(challenge.get_all_players()))):
+            self.add(challenge)
+    
+    def __len__(self):
+        return len(self.pending) + len(self.accepted)
+    
+    def add(self, challenge : Challenge) -> int:
+        if getattr(challenge, 'id', None) is None:
+            challenge.id = self._next_id
+        self._next_id = max(self._next_id, challenge.id + 1)
+        (self.accepted if challenge.accepted else self.pending)[challenge.id] = challenge
+        return challenge.id
+    
+    def accept(self, challenge : Challenge) -> None:
+        self.pending.pop(challenge.id, None)
+        self.accepted[challenge.id] = challenge
+    
+    def remove(self, challenge : Challenge) -> None:
+        self.pending.pop(challenge.id, None)
+        self.accepted.pop(challenge.id, None)
+    
+    def get(self, challenge_id : int) -> Challenge:
+        return self.pending.get(challenge_id) or self.accepted.get(challenge_id)
+    
+    def count(self, status : str = 'all') -> int:
+        return len(self) if status == 'all' else len(getattr(self, status))
+    
+    def page(self, status : str, start : int, count : int) -> [Challenge]:
+        """Returns count challenges from the start-th on, status being 'pending', 'accepted' or 'all'
+        (accepted first). Dictionaries can't be indexed, so this still walks the start challenges
+        before the page (O(start + count)); only the page's list is built, and a page of 'all'
+        past the accepted challenges skips them whole."""
+        if status == 'all':
+            if start >= len(self.accepted):
+                status, start = 'pending', start - len(self.accepted)
+            else:
+                challenges = itertools.chain(self.accepted.values(), self.pending.values())
+        if status != 'all':
+            challenges = getattr(self, status).values()
+        return list(itertools.islice(challenges, start, start + count))
+
+
 class ChallengeCommands():
     """Inherited by LadderManager. Supplies challenge-related commands."""
     def challenge_option(self, message: discord.Message) -> base.DirectedMessage:
@@ -60,7 +143,7 @@ class ChallengeCommands():
         team1 = self._get_player_team(message.author.id)
         
         try:
-            player2 = self._mention_strip(message.content)
+            player2 = self._mention_or_name_strip(message.content)
         except ValueError:
             return DirectedMessage('Cannot locate user', message.channel)
         
@@ -79,6 +162,9 @@ Or for some reason you are challenging yourself...''', message.channel)
             
         for player in challenge_value.get_all_players():
             self.challenges[player] = challenge_value
+        self.challenge_registry.add(challenge_value)
+        self._schedule_challenge_expiry(challenge_value)
+        self._temporary_data_changed()
         
         return DirectedMessage('Challenged: {team2}\nChallenger(s): {team1}'.format(
             team2 = ', '.join(challenge_value.get_challenged_players_names()),
@@ -96,12 +182,27 @@ Or for some reason you are challenging yourself...''', message.channel)
             if (self._player_in_chal_system(player)):
                 return False
         return True and challenge.get_challenger_team() != challenge.get_challenged_team()
+    
+    
+    def _schedule_challenge_expiry(self, challenge : Challenge, deadline : float = None) -> None:
+        """Unaccepted and accepted challenges time out separately (dynamic options challenge_timeout
+        and accepted_challenge_timeout), so abandoned ones don't block their players forever."""
+        timeout = self.dynamic_options['accepted_challenge_timeout' if challenge.accepted else 'challenge_timeout']
+        if timeout:
+            self.expiry.schedule(('challenge', challenge), deadline or time.time() + timeout)
+        else:
+            self.expiry.cancel(('challenge', challenge))
+    
+    
+    def _expire_challenge(self, challenge : Challenge) -> None:
+        if self.challenge_registry.get(challenge.id) is challenge:
+            self._delete_from_challenges(challenge)
+            print(f'Challenge between {challenge.get_challenger_players()} and {challenge.get_challenged_players()} expired.')
         
         
     def cancel_challenge_option(self, message : discord.Message) -> base.DirectedMessage:
         if message.author.id in self.challenges:
-            for player in self.challenges[message.author.id].get_all_players():
-                del self.challenges[player]
+            self._delete_from_challenges(self.challenges[message.author.id])
             return DirectedMessage('Challenge successfully declined', message.channel)
         return DirectedMessage('You have no challenge to decline.', message.channel)
     
@@ -115,14 +216,16 @@ Or for some reason you are challenging yourself...''', message.channel)
             return DirectedMessage('Challenge has already been accepted.', message.channel)
         else:
             self.challenges[message.author.id].accepted = True
+            self.challenge_registry.accept(self.challenges[message.author.id])
+            self._schedule_challenge_expiry(self.challenges[message.author.id])
+            self._temporary_data_changed()
             return DirectedMessage('Challenge successfully accepted', message.channel)
         
     
     #same command as cancel_challenge
     def decline_challenge_option(self, message : discord.Message) -> base.DirectedMessage:
         if message.author.id in self.challenges:
-            for player in self.challenges[message.author.id].get_all_players():
-                del self.challenges[player]
+            self._delete_from_challenges(self.challenges[message.author.id])
             return DirectedMessage('Challenge successfully declined', message.channel)
         return DirectedMessage('You have no challenge to decline.', message.channel)
     
@@ -141,25 +244,29 @@ Or for some reason you are challenging yourself...''', message.channel)
             return DirectedMessage('Challenged team needs to have accepted the challenge to report scores', message.channel)
         t1, t2 = challenge.get_teams(message.author.id)
         
-        message_cont = message.content.strip().lower()
-        descriptions = {'win': r'win|won|wins|wons',
-                        'loss': r'loss|lose|lost',
-                        'match': r'(#win#|#loss#) ?([1-9])?'}
-        
-        def name_re(re_dict : {str: str}) -> None:
-            """Mutates a given dictionary to implement named regex."""
-            for key in re_dict:
-                pattern = re.compile(f'#{key}#')
-                for other_key in re_dict:
-                    re_dict[other_key] = pattern.sub(f'(?:{re_dict[key]})', re_dict[other_key])
-        name_re(descriptions)
-        
-        if not re.search(descriptions['match'], message_cont):
+        sets = parse_report(message.content)
+        if sets is None:
             return DirectedMessage('Error: report syntax is wrong (should be "!report (win or loss) #, (win or loss) #").', message.channel)
+        if len(sets) > MAX_SETS:
+            return DirectedMessage(f'Error: a report can have at most {MAX_SETS} sets.', message.channel)
         
-        sets = ((base.WIN if re.match(descriptions['win'], outcome) else base.LOSS, int(amt))\
-                 for outcome, amt in re.findall(descriptions['match'], message_cont))
+        player_stats, t1mmr_delta, t2mmr_delta, t1wins, t2wins = self._play_match(challenge, t1, t2, sets)
         
+        with METRICS.timer('persistence', 'commit_match'):
+            self.storage.commit_match(player_stats, t1.get_players(), t2.get_players(), t1wins, t2wins)
+        with METRICS.timer('persistence', 'match_history'):
+            self.match_history.append(time.time(), player_stats.name, t1.get_players(), t2.get_players(),
+                                      sets, t1mmr_delta, t2mmr_delta)
+        self._delete_from_challenges(challenge)
+        string = self._inform_match(t1.get_players_names(), t2.get_players_names(),
+                                    t1wins, t2wins, t1mmr_delta, t2mmr_delta)
+        
+        return DirectedMessage(string, message.channel)
+    
+    
+    def _play_match(self, challenge : Challenge, t1 : Team, t2 : Team, sets : [(int, int)]) -> ('PlayerStatsRepository', int, int, int, int):
+        """Applies a reported match (sets from t1's side) to ratings, stats and records, without saving it.
+        Returns (player_stats, t1mmr_delta, t2mmr_delta, t1wins, t2wins)."""
         if self.dynamic_options['separate_1v1_mmr'] and challenge.get_is_1v1():
             player_stats = self.player_stats_1v1
         else:
@@ -169,8 +276,8 @@ Or for some reason you are challenging yourself...''', message.channel)
             self._create_player_account(player_stats, player)
         
         
-        t1mmr = sum((player_stats[player]['rating'] for player in t1.get_players()))//len(t1.get_players())
-        t2mmr = sum((player_stats[player]['rating'] for player in t2.get_players()))//len(t2.get_players())
+        t1mmr = t1.rating(player_stats)
+        t2mmr = t2.rating(player_stats)
         
         new_t1mmr, new_t2_mmr, t1wins, t2wins = base.mmr_calculator(
                                                             self.dynamic_options['base_rating_change'],
@@ -187,59 +294,105 @@ Or for some reason you are challenging yourself...''', message.channel)
         
         self._update_record_mass(t1.get_players(), t2.get_players(),
                                  t1wins, t2wins, player_stats)
-        self._update_record_mass(t2.get_players(), t1.get_players(),
-                                 t2wins, t1wins, player_stats)
-        
-        self._save_player_stats()
-        self._delete_from_challenges(challenge.get_all_players())
-        string = self._inform_match(t1.get_players_names(), t2.get_players_names(),
-                                    t1wins, t2wins, t1mmr_delta, t2mmr_delta)
-        
-        return DirectedMessage(string, message.channel)
+        return player_stats, t1mmr_delta, t2mmr_delta, t1wins, t2wins
     
     
-    def _delete_from_challenges(self, players : [int]) -> None:
-        for player in players:
-            del self.challenges[player]
+    async def bulk_report_option(self, message : discord.Message) -> base.DirectedMessage:
+        """Admin only (tournament organizers): reports many accepted challenges at once, one
+        "<challenge id> win 2, loss 1" line each (the challenger's side, ids as in !ongoing),
+        in the message or in attached text files. Nothing is applied unless every line is valid,
+        and the whole batch is saved with one journal write and one history write."""
+        if not self._is_admin(message.author):
+            return DirectedMessage('Only admins can bulk report.', message.channel)
+        
+        command_and_text = message.content.split(None, 1) #lines can start right after the command
+        text = command_and_text[1] if len(command_and_text) > 1 else ''
+        for attachment in message.attachments:
+            if attachment.size > BULK_REPORT_MAX_BYTES:
+                return DirectedMessage(f'Error: {attachment.filename} is too big to report.', message.channel)
+            content = io.BytesIO() #Attachment.read only exists from discord.py 1.1, save works on 1.0
+            await attachment.save(content)
+            text += '\n' + content.getvalue().decode('utf-8', 'replace')
+        
+        reports, errors = self._parse_bulk_report(text)
+        if errors or not reports:
+            return DirectedMessage(_fit('Nothing was reported. ' + ('Errors:\n' + '\n'.join(errors) if errors else
+                                        'Put one "<challenge id> win 2, loss 1" line per challenge below the command or in an attached file.')),
+                                   message.channel)
+        
+        matches, histories, lines = [], [], []
+        now = time.time()
+        for challenge, sets in reports:
+            t1, t2 = challenge.get_challenger_team(), challenge.get_challenged_team()
+            player_stats, t1mmr_delta, t2mmr_delta, t1wins, t2wins = self._play_match(challenge, t1, t2, sets)
+            matches.append((player_stats, t1.get_players(), t2.get_players(), t1wins, t2wins))
+            histories.append((now, player_stats.name, t1.get_players(), t2.get_players(), sets, t1mmr_delta, t2mmr_delta))
+            lines.append('#{}: ({}) {} - {} ({}), {:+d}/{:+d} mmr'.format(challenge.id, ', '.join(t1.get_players_names()), t1wins, t2wins,
+                                                                      ', '.join(t2.get_players_names()), t1mmr_delta, t2mmr_delta))
+        with METRICS.timer('persistence', 'commit_match'):
+            self.storage.commit_matches(matches)
+        with METRICS.timer('persistence', 'match_history'):
+            self.match_history.extend(histories)
+        for challenge, _ in reports:
+            self._delete_from_challenges(challenge)
+        
+        return DirectedMessage(_fit(f'Reported {len(reports)} challenges:\n' + '\n'.join(lines)), message.channel)
+    
+    
+    def _parse_bulk_report(self, text : str) -> ([(Challenge, [(int, int)])], [str]):
+        """Returns the (challenge, sets) of every line and the errors of the invalid ones."""
+        reports, errors, seen = [], [], set()
+        for number, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            match = BULK_REPORT_LINE.match(line)
+            challenge = self.challenge_registry.get(int(match.group(1))) if match else None
+            sets = parse_report(match.group(2)) if match else None
+            if match is None or sets is None:
+                errors.append(f'line {number}: should be "<challenge id> win 2, loss 1"')
+            elif len(sets) > MAX_SETS:
+                errors.append(f'line {number}: a report can have at most {MAX_SETS} sets')
+            elif challenge is None:
+                errors.append(f'line {number}: there is no challenge #{match.group(1)}')
+            elif not challenge.accepted:
+                errors.append(f'line {number}: challenge #{challenge.id} has not been accepted')
+            elif challenge.id in seen:
+                errors.append(f'line {number}: challenge #{challenge.id} is reported twice')
+            else:
+                seen.add(challenge.id)
+                reports.append((challenge, sets))
+        return reports, errors
+    
+    
+    def _delete_from_challenges(self, challenge : Challenge) -> None:
+        """Removes a challenge from the player index, the registry and the expiry schedule."""
+        for player in challenge.get_all_players():
+            if self.challenges.get(player) is challenge:
+                del self.challenges[player]
+        self.challenge_registry.remove(challenge)
+        self.expiry.cancel(('challenge', challenge))
+        self._temporary_data_changed()
             
     
-    def _set_stats_mass(self, players : [int], mmr_delta : int, wins : int, losses : int, player_stats : dict) -> None:
+    def _set_stats_mass(self, players : [int], mmr_delta : int, wins : int, losses : int, player_stats : 'PlayerStatsRepository') -> None:
         for player in players:
             self._set_stats(player, mmr_delta, wins, losses, player_stats)
     
     
-    def _set_stats(self, p1_id : int, mmr_delta : int, p1wins : int, p1losses : int, player_stats : dict):
-        player_stats[p1_id]['rating'] += mmr_delta
-        player_stats[p1_id]['wins'] += p1wins
-        player_stats[p1_id]['losses'] += p1losses
-    
+    def _set_stats(self, p1_id : int, mmr_delta : int, p1wins : int, p1losses : int, player_stats : 'PlayerStatsRepository'):
+        player_stats.update_stats(p1_id, mmr_delta, p1wins, p1losses)
     
-    def _add_record(self, user_id : int, player_stats : dict) -> None:
-        if user_id not in player_stats:
-            return False
-        if 'records' not in player_stats[user_id]:
-            player_stats[user_id]['records'] = {}
-        return True
     
-    
-    def _update_record_mass(self, players : [int], opponents : [int], wins : int, losses : int, player_stats : dict) -> None:
+    def _update_record_mass(self, players : [int], opponents : [int], wins : int, losses : int, player_stats : 'PlayerStatsRepository') -> None:
         for player in players:
             self._update_record(player, opponents, wins, losses, player_stats)
     
     
-    def _update_record(self, user_id : int, opponents : [int], wins : int, losses : int, player_stats : dict) -> None:
-        """Updates the record of a player vs any amount of opponents. Must be run separately for all involved players."""
-        user_worked = self._add_record(user_id, player_stats)
-        
-        if user_worked:
-            for opponent in opponents:
-                opponent_worked = self._add_record(opponent, player_stats)
-                if opponent_worked and not opponent in player_stats[user_id]['records']:
-                    player_stats[user_id]['records'][opponent] = defaultdict(int)
-                    player_stats[user_id]['records'][opponent]['wins'] += wins
-                    player_stats[user_id]['records'][opponent]['losses'] += losses
-                else:
-                    pass
+    def _update_record(self, user_id : int, opponents : [int], wins : int, losses : int, player_stats : 'PlayerStatsRepository') -> None:
+        """Updates the record of a player vs any amount of opponents (records are kept once per pair,
+           so only one side of a match is run)."""
+        for opponent in opponents:
+            player_stats.update_record(user_id, opponent, wins, losses)
     
 
     def _inform_match(self, challengers : [str], challenged : [str],
@@ -264,24 +417,10 @@ Each member of the other team gained {t2mmr_delta}mmr.'''
         return string
 
 
-    def _create_player_account(self,player_stats : dict, *id_list) -> None:
+    def _create_player_account(self,player_stats : 'PlayerStatsRepository', *id_list) -> None:
         """Creates an 'account' for a player in player_stats global variable if
         the player doesn't already have an account (accounts are associated with
         discord user ID."""
         
         for user_id in id_list:
-            if user_id not in player_stats:
-                player_stats[user_id] = {'rating': self.dynamic_options['starting_rating'],
-                                             'wins': 0,
-                                             'losses': 0,
-                                             'records': {}}
-    
-    
-    def _save_player_stats(self):
-        player_stats = self.player_stats
-        archived_player_stats = self._archived_player_stats
-        player_stats_1v1 = self.player_stats_1v1
-        archived_player_stats_1v1 = self._archived_player_stats_1v1
-        with open('laddermanager.pkl', 'wb') as saveFile:
-                pickle.dump([player_stats, archived_player_stats, player_stats_1v1, archived_player_stats_1v1], saveFile)
-        
\ No newline at end of file
+            player_stats.create_account(user_id, self.dynamic_options['starting_rating'])
@@ -10,94 +10,68 @@ class Command():
         self.command_name = command_name
 
 
-def match_command(message: discord.Message) -> Command:
-    """Matches the person's message to a specific command and returns that
-    command.
-    Returns None if a command could not be found."""
-    message = message.content.strip().lower()
-    COMMANDS = (
-        Command('help',
-                lambda message: \
-                message == '{}help'.format(DYNAMIC_OPTIONS['command_symbol']) \
-                or message == '{}h'.format(DYNAMIC_OPTIONS['command_symbol']) \
-                or message == '{}commands'.format(DYNAMIC_OPTIONS['command_symbol']) \
-                or message == '{}commandslist'.format(DYNAMIC_OPTIONS['command_symbol'])),
-        
-        Command('about',
-                lambda message: message == '{}about'.format(DYNAMIC_OPTIONS['command_symbol'])),
-        
-        Command('rules',
-                lambda message: message == '{}rules'.format(DYNAMIC_OPTIONS['command_symbol'])),
+'''Each command's pattern is matched right after the command symbol.
+Order matters: the first command whose pattern matches wins.'''
+COMMAND_PATTERNS = (
+    ('help', r'(?:help|h|commands|commandslist)\Z'),
+    ('about', r'about\Z'),
+    ('rules', r'rules\Z'),
+    ('leaderboard', r'leaderboard\Z'),
+    ('full_leaderboard', r'full.leaderboard|full\Z|full [0-9]'),
+    ('status_team', r'status team|team status|status'),
+    ('stats_self', r'(?:stats|rank|rating|status)\Z'),
+    ('stats_other', r'(?:stats|rank|rating|status) '),
+    ('record_self', r'record(?: (?:played|best|worst))?(?: [0-9]+)?\Z'),
+    ('record_other', r'record '),
+    ('ongoing', r'ongoing'),
+    ('challenge', r'challenge |play'),
+    ('accept_team', r'accept[\W_]team'),
+    ('accept_challenge', r'accept\Z'),
+    ('decline_challenge', r'decline\Z'),
+    ('cancel_challenge', r'cancel'),
+    ('bulk_report', r'bulk[\W_]?report|report[\W_]bulk'),
+    ('report_challenge', r'report '),
+    ('create_team', r'create |create_team|create[\W_]team'),
+    ('invite_team', r'invite'),
+    ('leave_team', r'leave'),
+    ('metrics', r'metrics\Z'),
+    ('antis', r'.*antis')
+    )
+
+
+class CommandDispatcher():
+    """Matches messages against every command with a single precompiled regex.
+        The regex is rebuilt whenever the command symbol option changes."""
+    def __init__(self, patterns : ((str, str)) = COMMAND_PATTERNS):
+        self._patterns = patterns
+        self._build(DYNAMIC_OPTIONS['command_symbol'])
 
-        Command('leaderboard',
-                lambda message: message == '{}leaderboard'.format(DYNAMIC_OPTIONS['command_symbol'])),
 
-        Command('full_leaderboard',
-                lambda message: \
-                re.match(r'{}full.leaderboard'.format(DYNAMIC_OPTIONS['command_symbol']), message) \
-                or message == '{}full'.format(DYNAMIC_OPTIONS['command_symbol'])),
-        
-        Command('status_team',
-                lambda m : m.startswith('{}status team'.format(DYNAMIC_OPTIONS['command_symbol'])) or\
-                m.startswith('{}team status'.format(DYNAMIC_OPTIONS['command_symbol'])) or\
-                m.startswith('{}status'.format(DYNAMIC_OPTIONS['command_symbol']))),
+    def _build(self, symbol : str) -> None:
+        self._symbol = symbol
+        self._regex = re.compile(re.escape(symbol) + '(?:' +
+                                 '|'.join(f'(?P<{name}>{pattern})' for name, pattern in self._patterns) + ')',
+                                 re.DOTALL)
+        self._commands = {name: Command(name, self._regex) for name, _ in self._patterns}
 
-        Command('stats_self',
-                lambda message: re.match(r'{}stats$'.format(DYNAMIC_OPTIONS['command_symbol']), message) \
-                or re.match(r'{}rank$'.format(DYNAMIC_OPTIONS['command_symbol']), message) \
-                or re.match(r'{}rating$'.format(DYNAMIC_OPTIONS['command_symbol']), message) \
-                or re.match(r'{}status$'.format(DYNAMIC_OPTIONS['command_symbol']), message)),
 
-        Command('stats_other',
-                lambda message: message.startswith('{}stats '.format(DYNAMIC_OPTIONS['command_symbol'])) \
-                or message.startswith('{}rank '.format(DYNAMIC_OPTIONS['command_symbol'])) \
-                or message.startswith('{}rating '.format(DYNAMIC_OPTIONS['command_symbol'])) \
-                or message.startswith('{}status '.format(DYNAMIC_OPTIONS['command_symbol']))),
+    def match(self, content : str) -> Command:
+        """Returns the command content invokes, or None."""
+        symbol = DYNAMIC_OPTIONS['command_symbol']
+        if not content.startswith(symbol):
+            return None
+        if symbol != self._symbol:
+            self._build(symbol)
 
-        Command('record_self',
-                lambda message: re.match(r'{}record$'.format(DYNAMIC_OPTIONS['command_symbol']), message)),
+        match = self._regex.match(content)
+        if match:
+            return self._commands[match.lastgroup]
 
-        Command('record_other',
-                lambda message: message.startswith('{}record '.format(DYNAMIC_OPTIONS['command_symbol']))),
-        
-        Command('ongoing',
-                lambda m : m.startswith('{}ongoing'.format(DYNAMIC_OPTIONS['command_symbol']))),
-        
-        Command('challenge',
-                lambda message: message.startswith('{}challenge '.format(DYNAMIC_OPTIONS['command_symbol'])) \
-                or message.startswith('{}play'.format(DYNAMIC_OPTIONS['command_symbol']))),
-        
-        Command('accept_team',
-                lambda m : re.match(r'{}accept[\W_]team'.format(DYNAMIC_OPTIONS['command_symbol']), m)),
-        
-        Command('accept_challenge',
-                lambda message: message == '{}accept'.format(DYNAMIC_OPTIONS['command_symbol'])),
-        
-        Command('decline_challenge',
-                lambda message: message == '{}decline'.format(DYNAMIC_OPTIONS['command_symbol'])),
-        
-        Command('cancel_challenge',
-                lambda m : m.startswith('{}cancel'.format(DYNAMIC_OPTIONS['command_symbol']))),
-        
-        Command('report_challenge',
-                lambda message: message.startswith('{}report '.format(DYNAMIC_OPTIONS['command_symbol']))),
-        
-        Command('create_team',
-                lambda m : m.startswith('{}create '.format(DYNAMIC_OPTIONS['command_symbol'])) or\
-                m.startswith('{}create_team'.format(DYNAMIC_OPTIONS['command_symbol'])) or
-                re.match(r'{}create[\W_]team'.format(DYNAMIC_OPTIONS['command_symbol']), m)),
-        
-        Command('invite_team',
-                lambda m : m.startswith('{}invite'.format(DYNAMIC_OPTIONS['command_symbol']))),
-        
-        Command('leave_team',
-                lambda m : m.startswith('{}leave'.format(DYNAMIC_OPTIONS['command_symbol'])) or\
-                re.match(r'{}leave[\W_]team'.format(DYNAMIC_OPTIONS['command_symbol']), m)),
-        
-        Command('antis',
-                lambda m : m.startswith(DYNAMIC_OPTIONS['command_symbol']) and 'antis' in m)
-        )
 
-    for command in COMMANDS:
-        if command.match(message):
-            return command
+_dispatcher = CommandDispatcher()
+
+def match_command(message: discord.Message) -> Command:
+    """Matches the person's message to a specific command and returns that
+    command.
+    Returns None if a command could not be found."""
+    return _dispatcher.match(message.content.strip().lower())
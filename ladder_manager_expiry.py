@@ -0,0 +1,91 @@
+import time
+import heapq
+import asyncio
+import itertools
+
+COMPACT_RATIO = 2 #the heap is rebuilt once it holds this many times more entries than live deadlines
+
+
+class ExpiryScheduler():
+    """Calls expire(key) once a key's deadline (a time.time() value, so deadlines can be
+        saved and survive restarts) has passed. Deadlines sit in a min-heap: scheduling is
+        O(log n), cancelling drops the key from deadlines and leaves its heap entry to be
+        skipped when popped, and a single timer on the event loop waits for the earliest
+        deadline, so nothing ever scans every entry."""
+    def __init__(self, expire : 'callable'):
+        self._expire = expire
+        self.deadlines = {} #key: deadline
+        self._heap = [] #(deadline, sequence number, key), may hold cancelled or rescheduled entries
+        self._sequence = itertools.count() #orders equal deadlines, keys themselves needn't be comparable
+        self._timer = None
+        self._timer_deadline = None
+
+
+    def __len__(self):
+        return len(self.deadlines)
+
+
+    def schedule(self, key, deadline : float) -> None:
+        """Sets (or moves) the deadline of key."""
+        self.deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._sequence), key))
+        if len(self._heap) > COMPACT_RATIO * len(self.deadlines) + 64:
+            self._compact()
+        self._arm()
+
+
+    def cancel(self, key) -> None:
+        self.deadlines.pop(key, None)
+
+
+    def expire_due(self, now : float = None) -> int:
+        """Expires every key whose deadline has passed, returns how many."""
+        now = time.time() if now is None else now
+        expired = 0
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self._heap)
+            if self.deadlines.get(key) != deadline: #cancelled or rescheduled since
+                continue
+            del self.deadlines[key]
+            self._expire(key)
+            expired += 1
+        return expired
+
+
+    def stop(self) -> None:
+        """Cancels the timer (the ladder is being unloaded, its deadlines are saved with it)."""
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self._timer_deadline = None
+
+
+    def _arm(self) -> None:
+        """Points the timer at the earliest deadline if it isn't already set for an earlier one.
+            Without a running event loop (offline tools) expire_due has to be called directly."""
+        while self._heap and self.deadlines.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return
+        deadline = self._heap[0][0]
+        if self._timer is not None and self._timer_deadline <= deadline:
+            return
+
+        loop = asyncio.get_event_loop()
+        if not loop.is_running():
+            return
+        self.stop()
+        self._timer = loop.call_later(max(0, deadline - time.time()), self._on_timer)
+        self._timer_deadline = deadline
+
+
+    def _on_timer(self) -> None:
+        self._timer = self._timer_deadline = None
+        try:
+            self.expire_due()
+        finally:
+            self._arm()
+
+
+    def _compact(self) -> None:
+        self._heap = [(deadline, next(self._sequence), key) for key, deadline in self.deadlines.items()]
+        heapq.heapify(self._heap)
@@ -0,0 +1,123 @@
+'''In-memory stand-ins for the discord objects the ladder touches, so the bot can be
+driven offline (see ladder_manager_benchmark and ladder_manager_replay).
+Everything sent to a fake user or channel is appended to FakeClient.sent as
+(channel id, text) in send order.'''
+import random
+
+SYLLABLES = ('an', 'ti', 'sa', 'ko', 'ru', 'mi', 'de', 'lo', 'ven', 'tor', 'ka', 'zu', 'ri', 'el', 'mo', 'ash',
+             'ny', 'qu', 'ba', 'fe', 'gi', 'ho', 'ja', 'xi', 'ul', 'yo', 'pe', 'wa', 'st', 'or')
+
+
+class FakePermissions():
+    def __init__(self, administrator : bool = False):
+        self.administrator = administrator
+
+
+class FakeUser():
+    """Plays both discord.User and discord.Member (messages sent to it are DMs)."""
+    def __init__(self, user_id : int, name : str, sent : list, administrator : bool = False):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.bot = False
+        self.guild_permissions = FakePermissions(administrator)
+        self._sent = sent
+
+    @property
+    def mention(self) -> str:
+        return f'<@{self.id}>'
+
+    async def send(self, content : str) -> None:
+        self._sent.append((self.id, content))
+
+
+class FakeChannel():
+    def __init__(self, channel_id : int, name : str, guild : 'FakeGuild', sent : list):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self._sent = sent
+
+    async def send(self, content : str) -> None:
+        self._sent.append((self.id, content))
+
+
+class FakeGuild():
+    def __init__(self, guild_id : int, name : str):
+        self.id = guild_id
+        self.name = name
+        self._members = {}
+
+    @property
+    def members(self) -> [FakeUser]:
+        return list(self._members.values())
+
+    def add_member(self, member : FakeUser) -> None:
+        self._members[member.id] = member
+
+    def remove_member(self, user_id : int) -> None:
+        self._members.pop(user_id, None)
+
+    def get_member(self, user_id : int) -> FakeUser:
+        return self._members.get(user_id)
+
+
+class FakeMessage():
+    def __init__(self, author : FakeUser, content : str, channel : FakeChannel):
+        self.author = author
+        self.content = content
+        self.channel = channel
+        self.guild = channel.guild
+        self.attachments = []
+
+
+class FakeClient():
+    """The parts of discord.Client the ladder reads, plus helpers to populate it."""
+    def __init__(self):
+        self.sent = []
+        self.user = FakeUser(0, 'LadderManager', self.sent)
+        self.guilds = []
+        self._users = {}
+        self._channels = 0
+
+    @property
+    def users(self) -> [FakeUser]:
+        return list(self._users.values())
+
+    def get_user(self, user_id : int) -> FakeUser:
+        return self._users.get(user_id)
+
+    def get_guild(self, guild_id : int) -> FakeGuild:
+        return next((guild for guild in self.guilds if guild.id == guild_id), None)
+
+    def event(self, coroutine):
+        return coroutine
+
+    async def close(self) -> None:
+        self.closed = True
+
+    def run(self, *args) -> None:
+        raise RuntimeError('FakeClient has no gateway to connect to, call the events directly.')
+
+    def add_guild(self, name : str) -> FakeGuild:
+        guild = FakeGuild(len(self.guilds) + 1, name)
+        self.guilds.append(guild)
+        return guild
+
+    def add_channel(self, guild : FakeGuild, name : str, channel_id : int = None) -> FakeChannel:
+        self._channels += 1
+        return FakeChannel(channel_id or self._channels, name, guild, self.sent)
+
+    def add_user(self, user_id : int, name : str, guild : FakeGuild, administrator : bool = False) -> FakeUser:
+        user = FakeUser(user_id, name, self.sent, administrator)
+        self._users[user_id] = user
+        guild.add_member(user)
+        return user
+
+    def add_users(self, count : int, guild : FakeGuild, first_id : int = 100000, seed : int = 0) -> [FakeUser]:
+        """Adds count members with made up (sometimes shared) names and ids from first_id up."""
+        rng = random.Random(seed)
+        return [self.add_user(first_id + number,
+                              ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) + str(rng.randint(0, 99)),
+                              guild)
+                for number in range(count)]
@@ -0,0 +1,199 @@
+import os
+import time
+import asyncio
+import contextlib
+from typing import TYPE_CHECKING
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+if TYPE_CHECKING: #annotations only, ladder_manager_main imports this module
+    import discord
+    from ladder_manager_main import LadderManager
+
+LADDER_FILES = ('laddermanager.pkl', 'laddermanager_journal.log', 'laddermanager_journal.log.old', 'laddermanager.db',
+                'laddermanager_tmp.pkl', 'laddermanager_history.bin') #everything one ladder saves
+
+
+class GuildLadders():
+    """One ladder (LadderManager) per guild, each with its own files in directory/<guild id>/,
+        so guilds never share stats, teams, challenges or save files.
+        The ladder in the bot's own folder (the only one before ladders were kept per guild)
+        belongs to default_guild_id and answers commands sent in DMs. Without a default_guild_id
+        DMs get their own ladder in directory/dm/ and the old ladder moves to its guild
+        (see adopt_legacy_ladder).
+        Ladders are loaded by the first command that needs them; past max_loaded the
+        least recently used one is saved and unloaded, as are ladders idle for idle_timeout
+        seconds (see evict_idle), so memory follows the active guilds, not all of them.
+        While the event loop runs, an unloaded ladder is written out on a thread of its own
+        (snapshots of big ladders take a while), and the guild's next command waits for it."""
+    def __init__(self, open_ladder : 'callable', directory : str, default_guild_id : int = None,
+                 max_loaded : int = 0, idle_timeout : float = 0):
+        self._open_ladder = open_ladder #(guild_id, directory) -> LadderManager
+        self.directory = directory
+        self.default_guild_id = default_guild_id
+        self.max_loaded = max_loaded #0 for no limit
+        self.idle_timeout = idle_timeout #0 keeps idle ladders loaded
+        self.reconcile = False #set once users are indexed (on_ready), see get
+        self._ladders = OrderedDict() #guild id (None for the default ladder): LadderManager, least recently used first
+        self._last_used = {} #guild id: time.monotonic() of the ladder's last use
+        self._in_use = {} #guild id: handlers running on the ladder (it isn't unloaded under them, see in_use)
+        self._unloading = {} #guild id: future of the unloaded ladder's last writes, see _unload
+        self._unloader = ThreadPoolExecutor(max_workers = 1) #one ladder is written out at a time
+
+
+    def _key(self, guild_id : int) -> int:
+        return None if guild_id == self.default_guild_id else guild_id
+
+
+    def directory_of(self, guild_id : int) -> str:
+        key = self._key(guild_id)
+        if key is None:
+            return '.' if self.default_guild_id is not None else os.path.join(self.directory, 'dm')
+        return os.path.join(self.directory, str(key))
+
+
+    def adopt_legacy_ladder(self, guild_ids : [int]) -> bool:
+        """Moves the ladder files left in the bot's folder by versions without per guild ladders
+        into the folder of the bot's only guild (called on_ready, before any ladder is loaded).
+        Returns False if they can't be given to a guild safely: the bot is in several guilds
+        (or its only guild has a ladder already) and default_guild_id doesn't say which owns them."""
+        legacy_files = [file_name for file_name in LADDER_FILES if os.path.exists(file_name)]
+        if self.default_guild_id is not None or not legacy_files:
+            return True
+        guild_ids = list(guild_ids)
+        if len(guild_ids) != 1 or os.path.exists(os.path.join(self.directory, str(guild_ids[0]))):
+            print(f'''Ladder files from an older version ({', '.join(legacy_files)}) were found but the ladder
+they belong to can't be worked out. Set the default_guild_id dynamic option to the id of the guild
+they belong to (or move them into {self.directory}/<guild id>/) and start the bot again.''')
+            return False
+        directory = os.path.join(self.directory, str(guild_ids[0]))
+        os.makedirs(directory)
+        for file_name in legacy_files:
+            os.replace(file_name, os.path.join(directory, file_name))
+        print(f'Moved the ladder files of the bot\'s folder to {directory}/, the ladder of the bot\'s only guild.')
+        return True
+
+
+    def get(self, guild_id : int) -> 'LadderManager':
+        """Returns the ladder of a guild (None for DMs), loading or creating it if needed.
+        A ladder loaded after on_ready catches up on the joins and leaves it missed while unloaded."""
+        key = self._key(guild_id)
+        self._last_used[key] = time.monotonic()
+        if key in self._ladders:
+            self._ladders.move_to_end(key)
+            return self._ladders[key]
+        if key in self._unloading: #still being written out, on_message awaits this first (see unloaded)
+            self._unloading[key].result()
+
+        directory = self.directory_of(key)
+        os.makedirs(directory, exist_ok = True)
+        ladder = self._open_ladder(self.default_guild_id if key is None else key, directory)
+        if self.reconcile:
+            ladder.reconcile_player_stats()
+        self._ladders[key] = ladder
+        while self.max_loaded and len(self._ladders) > self.max_loaded:
+            unused = next((other for other in self._ladders if other != key and not self._in_use.get(other)), key)
+            if unused == key: #every other ladder is busy, go over the limit until one is done
+                break
+            self._unload(unused)
+        return ladder
+
+
+    @contextlib.contextmanager
+    def in_use(self, ladder : 'LadderManager'):
+        """Keeps a ladder loaded while a handler that awaits (eg. downloads) works on it."""
+        key = self._key(ladder.guild_id)
+        self._in_use[key] = self._in_use.get(key, 0) + 1
+        try:
+            yield ladder
+        finally:
+            self._in_use[key] -= 1
+            if not self._in_use[key]:
+                del self._in_use[key]
+
+
+    def for_message(self, message : 'discord.Message') -> 'LadderManager':
+        return self.get(message.guild.id if message.guild is not None else None)
+
+
+    async def unloaded(self, message : 'discord.Message') -> None:
+        """Waits until the ladder of a message's guild has been written out if it's being unloaded,
+        so for_message can load it again without blocking the loop."""
+        pending = self._unloading.get(self._key(message.guild.id if message.guild is not None else None))
+        if pending is not None:
+            await asyncio.wrap_future(pending)
+
+
+    def loaded(self, guild_id : int) -> 'LadderManager':
+        """Returns the ladder of a guild if it's loaded, without loading it (or marking it used)."""
+        return self._ladders.get(self._key(guild_id))
+
+
+    def all_loaded(self) -> ['LadderManager']:
+        return list(self._ladders.values())
+
+
+    def member_joined(self, member : 'discord.Member') -> None:
+        """Returns the member to their guild's ladder and the default ladder if they were archived."""
+        for ladder in {self.loaded(member.guild.id), self.loaded(None)} - {None}:
+            ladder.player_joined(member.id)
+
+
+    def member_left(self, member : 'discord.Member', left_every_guild : bool) -> None:
+        """Archives the member in their guild's ladder, and in the default ladder once
+           they share no guild with the bot (unless it belongs to a guild itself)."""
+        ladder = self.loaded(member.guild.id)
+        if ladder is not None and ladder.guild_id is not None:
+            ladder.player_left(member.id)
+        default = self.loaded(None)
+        if left_every_guild and default is not None and default.guild_id is None:
+            default.player_left(member.id)
+
+
+    def evict_idle(self) -> int:
+        """Unloads the ladders unused for idle_timeout seconds, returns how many."""
+        if not self.idle_timeout:
+            return 0
+        cutoff = time.monotonic() - self.idle_timeout
+        idle = [key for key in self._ladders if self._last_used[key] < cutoff and not self._in_use.get(key)]
+        for key in idle:
+            self._unload(key)
+        return len(idle)
+
+
+    def _unload(self, key : int, wait : bool = False) -> None:
+        """Writes out and closes a ladder, the next command in its guild loads it again.
+        Nothing touches the ladder once it's dropped, so with a running loop (and unless told
+        to wait) its writes happen on the unloader thread."""
+        ladder = self._ladders.pop(key)
+        del self._last_used[key]
+        ladder.expiry.stop()
+        ladder.save_scheduler.cancel()
+        loop = asyncio.get_event_loop()
+        if wait or not loop.is_running():
+            self._write_out(key, ladder)
+            return
+        pending = self._unloader.submit(self._write_out, key, ladder)
+        self._unloading[key] = pending
+        pending.add_done_callback(lambda _: loop.call_soon_threadsafe(self._unloaded, key, pending))
+
+
+    def _write_out(self, key : int, ladder : 'LadderManager') -> None:
+        ladder.save_scheduler.flush()
+        ladder.storage.close()
+        print(f'Unloaded the ladder of guild {key}.' if key is not None else 'Unloaded the default ladder.')
+
+
+    def _unloaded(self, key : int, pending : Future) -> None:
+        if self._unloading.get(key) is pending:
+            del self._unloading[key]
+        if pending.exception() is not None:
+            print(f'The ladder of guild {key} could not be written out, exception: {pending.exception()}.')
+
+
+    def close(self) -> None:
+        """Writes out and closes every loaded ladder, after the ones still being unloaded."""
+        for pending in list(self._unloading.values()):
+            pending.exception() #waits, _unloaded reports failures
+        for key in list(self._ladders):
+            self._unload(key, wait = True)
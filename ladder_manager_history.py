@@ -0,0 +1,139 @@
+import os
+import mmap
+import bisect
+import struct
+from array import array
+from collections import namedtuple
+
+from ladder_manager_storage import LADDERS
+
+HistoricMatch = namedtuple('HistoricMatch', 'timestamp ladder team1 team2 sets team1_delta team2_delta')
+
+_HEADER = struct.Struct('<dBBBBii') #timestamp, ladder, team 1 size, team 2 size, number of sets, team 1 delta, team 2 delta
+MAX_SETS = 255 #sets of one match, the count is stored in a byte (reports are checked against it before they're applied)
+
+
+class MatchHistory():
+    """Every reported match, stored column by column in typed arrays.
+        team1 is always the reporting team, sets are (outcome, amount) from its point of view.
+        Variable length columns (players, sets) are flat arrays sliced by per-match offsets,
+        so a match costs a few dozen bytes instead of a handful of python objects.
+        Matches are appended to a binary file as they're reported and read back on startup.
+        Offline tools open it read_only: the bot may be appending to the file, so a match that
+        looks half written is skipped rather than cut off."""
+    def __init__(self, path : str, read_only : bool = False):
+        self.path = path
+        self.read_only = read_only
+        self._timestamps = array('d')
+        self._ladders = array('B')
+        self._team1_sizes = array('B')
+        self._player_offsets = array('Q', [0])
+        self._players = array('Q')
+        self._set_offsets = array('Q', [0])
+        self._sets = array('h') #outcome * amount
+        self._deltas = array('i') #team 1 delta, team 2 delta for every match
+        self._player_matches = {} #user_id: array of match indices, ascending
+        self._load()
+
+
+    def __len__(self):
+        return len(self._timestamps)
+
+
+    def append(self, timestamp : float, ladder : str, team1 : [int], team2 : [int],
+               sets : [(int, int)], team1_delta : int, team2_delta : int) -> int:
+        """Records a match and returns its index."""
+        return self.extend([(timestamp, ladder, team1, team2, sets, team1_delta, team2_delta)])[0]
+
+
+    def extend(self, matches : [(float, str, [int], [int], [(int, int)], int, int)]) -> range:
+        """Records several matches (append's arguments each) with one synced write, returns their indices."""
+        records = []
+        last = self._timestamps[-1] if self._timestamps else None
+        for timestamp, ladder, team1, team2, sets, team1_delta, team2_delta in matches:
+            if last is not None and timestamp < last: #keep time ordered for bisecting (clock changes)
+                timestamp = last
+            last = timestamp
+            record = _HEADER.pack(timestamp, LADDERS.index(ladder), len(team1), len(team2), len(sets),
+                                  team1_delta, team2_delta)
+            record += array('Q', list(team1) + list(team2)).tobytes()
+            record += array('h', [outcome * amount for outcome, amount in sets]).tobytes()
+            records.append(record)
+        with open(self.path, 'ab') as history:
+            history.write(b''.join(records))
+            history.flush()
+            os.fsync(history.fileno())
+        first = len(self)
+        for record in records:
+            self._add(record, 0)
+        return range(first, len(self))
+
+
+    def match(self, index : int) -> HistoricMatch:
+        players = self._players[self._player_offsets[index]:self._player_offsets[index + 1]]
+        team1_size = self._team1_sizes[index]
+        sets = self._sets[self._set_offsets[index]:self._set_offsets[index + 1]]
+        return HistoricMatch(self._timestamps[index], LADDERS[self._ladders[index]],
+                             list(players[:team1_size]), list(players[team1_size:]),
+                             [(1 if amount > 0 else -1, abs(amount)) for amount in sets],
+                             self._deltas[2 * index], self._deltas[2 * index + 1])
+
+
+    def between(self, start_time : float = None, end_time : float = None) -> range:
+        """Returns the indices of matches reported in [start_time, end_time)."""
+        start = 0 if start_time is None else bisect.bisect_left(self._timestamps, start_time)
+        end = len(self) if end_time is None else bisect.bisect_left(self._timestamps, end_time)
+        return range(start, end)
+
+
+    def for_player(self, user_id : int, start_time : float = None, end_time : float = None) -> [int]:
+        """Returns the indices of a player's matches reported in [start_time, end_time)."""
+        indices = self._player_matches.get(user_id, array('I'))
+        time_range = self.between(start_time, end_time)
+        return indices[bisect.bisect_left(indices, time_range.start):bisect.bisect_left(indices, time_range.stop)]
+
+
+    def _add(self, data : bytes, offset : int) -> int:
+        """Adds the match encoded at data[offset:] to the columns and indexes it."""
+        timestamp, ladder, team1_size, team2_size, set_count, team1_delta, team2_delta = _HEADER.unpack_from(data, offset)
+        offset += _HEADER.size
+        players = array('Q', data[offset:offset + 8 * (team1_size + team2_size)])
+        offset += 8 * (team1_size + team2_size)
+        sets = array('h', data[offset:offset + 2 * set_count])
+
+        index = len(self)
+        self._timestamps.append(timestamp)
+        self._ladders.append(ladder)
+        self._team1_sizes.append(team1_size)
+        self._players.extend(players)
+        self._player_offsets.append(len(self._players))
+        self._sets.extend(sets)
+        self._set_offsets.append(len(self._sets))
+        self._deltas.extend((team1_delta, team2_delta))
+        for player in players:
+            self._player_matches.setdefault(player, array('I')).append(index)
+        return index
+
+
+    def _load(self) -> None:
+        """Reads the history file, cutting off a match left half written by a crash (unless read_only)."""
+        try:
+            with open(self.path, 'rb') as history:
+                size = os.fstat(history.fileno()).st_size
+                if not size:
+                    return
+                with mmap.mmap(history.fileno(), 0, access = mmap.ACCESS_READ) as data:
+                    offset = 0
+                    while offset + _HEADER.size <= size:
+                        _, _, team1_size, team2_size, set_count, _, _ = _HEADER.unpack_from(data, offset)
+                        length = _HEADER.size + 8 * (team1_size + team2_size) + 2 * set_count
+                        if offset + length > size:
+                            break
+                        self._add(data, offset)
+                        offset += length
+        except FileNotFoundError:
+            return
+
+        if offset != size and not self.read_only:
+            with open(self.path, 'r+b') as history:
+                history.truncate(offset)
@@ -1,17 +1,40 @@
+import re
+import time
+import heapq
 import random
+import asyncio
+from typing import TYPE_CHECKING
 
 import discord
 
 import ladder_manager_base as base
 from ladder_manager_base import Team
+from ladder_manager_metrics import METRICS
 from dynamic_options import DYNAMIC_OPTIONS
 
+if TYPE_CHECKING: #annotations only
+    from ladder_manager_storage import PlayerStatsRepository
+
 
         
 def create_line() -> str:
     return 30*'~'
 
 
+def _win_rate(record : dict) -> float:
+    games = record['wins'] + record['losses']
+    return record['wins'] / games if games else 0.0
+
+
+#sort keys of (opponent id, record) for the record command, smallest first
+RECORD_ORDERS = {'played': lambda matchup: (-matchup[1]['wins'] - matchup[1]['losses'], matchup[0]),
+                 'best': lambda matchup: (-_win_rate(matchup[1]), -matchup[1]['wins'] - matchup[1]['losses'], matchup[0]),
+                 'worst': lambda matchup: (_win_rate(matchup[1]), -matchup[1]['wins'] - matchup[1]['losses'], matchup[0])}
+RECORD_ORDER_DESCRIPTIONS = {'played': 'most played first',
+                             'best': 'best win rate first',
+                             'worst': 'worst win rate first'}
+
+
 class InformationCommands():
     """Inherited by LadderManager. Supplies information-related commands."""
     """Help text provided when help_option function is called."""
@@ -23,22 +46,24 @@ class InformationCommands():
                   ('{}about'.format(DYNAMIC_OPTIONS['command_symbol']), 'About this bot'),
                   ('{}rules'.format(DYNAMIC_OPTIONS['command_symbol']), 'Rules of this ladder system'),
                   ('{}leaderboard'.format(DYNAMIC_OPTIONS['command_symbol']), 'Top players leaderboard'),
-                  ('{}full_leaderboard'.format(DYNAMIC_OPTIONS['command_symbol']), 'All players leaderboard'),
+                  ('{}full_leaderboard <page>'.format(DYNAMIC_OPTIONS['command_symbol']), 'All players leaderboard, one page at a time'),
                   ('{}stats'.format(DYNAMIC_OPTIONS['command_symbol']), 'Your stats'),
-                  ('{}stats @username'.format(DYNAMIC_OPTIONS['command_symbol']), '@username\'s stats'),
-                  ('{}record'.format(DYNAMIC_OPTIONS['command_symbol']), 'Your record vs other players'),
-                  ('{}record @username'.format(DYNAMIC_OPTIONS['command_symbol']), '@username\'s record vs other players'),
+                  ('{}stats @username'.format(DYNAMIC_OPTIONS['command_symbol']), '@username\'s stats (a plain name works too)'),
+                  ('{}record [played/best/worst] <page>'.format(DYNAMIC_OPTIONS['command_symbol']), 'Your record vs other players, most played first by default'),
+                  ('{}record @username'.format(DYNAMIC_OPTIONS['command_symbol']), '@username\'s record vs other players (same options)'),
                   
                   ('Challenge Options', create_line()),
                   ('{}play @username'.format(DYNAMIC_OPTIONS['command_symbol']), 'challenge @username to a set'),
                   ('{}accept'.format(DYNAMIC_OPTIONS['command_symbol']), 'accept a received challenge'),
                   ('{}decline'.format(DYNAMIC_OPTIONS['command_symbol']), 'decline a received challenge'),
-                  ('{}ongoing'.format(DYNAMIC_OPTIONS['command_symbol']), 'see ongoing challenges (accepted and not accepted)'),
+                  ('{}ongoing [accepted/pending] <page>'.format(DYNAMIC_OPTIONS['command_symbol']), 'see ongoing challenges (accepted and not accepted by default)'),
                   ('{command_symbol}report'.format(command_symbol = DYNAMIC_OPTIONS['command_symbol']), '''reports wins and losses for a challenge and concludes the challenge.
                         Order matters!! Example commands:
                         "{command_symbol}report win 2, loss 1"
                         "{command_symbol}report loss 3"
                         "{command_symbol}report win 1, loss 1, win 1"'''.format(command_symbol = DYNAMIC_OPTIONS['command_symbol'])),
+                  ('{}bulk_report'.format(DYNAMIC_OPTIONS['command_symbol']), '''admins: reports many accepted challenges at once, one line each in the message
+                        or an attached file, like "12 win 2, loss 1" (challenge id from {}ongoing, challenger's side)'''.format(DYNAMIC_OPTIONS['command_symbol'])),
                   
                   ('Team Options', create_line()),
                   ('Note', 'All members on a team must have accepted the team invite before they can challenge another team.'),
@@ -78,35 +103,67 @@ Thank you for using LadderManager.\n\n'''
         return base.DirectedMessage('Rules:\n' + self._get_rules_text(), message.author)
 
     
-    def _filter_player_stats(self, player_stats : dict, archived_player_stats : dict) -> None:
+    async def metrics_option(self, message : discord.Message) -> base.DirectedMessage:
+        """Admin only: DMs the latency of every stage of handling messages so far
+           and refreshes the prometheus metrics file (written on an executor)."""
+        if not self._is_admin(message.author):
+            return base.DirectedMessage('Only admins can view metrics.', message.channel)
+        if self.dynamic_options['metrics_file']:
+            await asyncio.get_event_loop().run_in_executor(None, METRICS.write_prometheus,
+                                                           self.dynamic_options['metrics_file'], METRICS.prometheus_text())
+        return base.DirectedMessage('```' + METRICS.summary()[:1990] + '```', message.author)
+
+    
+    def _filter_player_stats(self, player_stats : 'PlayerStatsRepository') -> None:
         """Eliminates players who are no longer on the server from player_stats so generate leaderboard
-        works properly."""
-        for player in dict(player_stats):
-            if self._find_user(player) == None:
-                archived_player_stats[player] = player_stats[player]
-                del player_stats[player]
-                print(f'Deleted player (id: {player}) since system cannot find them in any server.')
+        works properly. Only needed for leaves missed while the bot was offline (see reconcile_player_stats)."""
+        for player in player_stats.player_ids():
+            if not self._is_ladder_member(player):
+                player_stats.archive(player)
+                self._solo_teams.pop(player, None)
+                print(f'Deleted player (id: {player}) since system cannot find them in the ladder\'s server.')
             
     
-    def _return_player_stats(self, player_stats : dict, archived_player_stats : dict) -> None:
+    def _return_player_stats(self, player_stats : 'PlayerStatsRepository') -> None:
         """Returns archived players back into player stats if they can be detected again."""
-        for player in dict(archived_player_stats):
-            if self._find_user(player):
-                player_stats[player] = archived_player_stats[player]
-                del archived_player_stats[player]
+        for player in player_stats.archived_ids():
+            if self._is_ladder_member(player):
+                player_stats.restore(player)
                 print(f'Returned player (id: {player}) to the player stats system since they can be found (previously they were missing).')
+    
+    
+    def reconcile_player_stats(self) -> None:
+        """Archives/returns players whose leaves and joins happened while the bot was offline.
+        Run once on_ready, afterwards player_left and player_joined keep the ladders current."""
+        for player_stats in (self.player_stats, self.player_stats_1v1):
+            self._return_player_stats(player_stats)
+            self._filter_player_stats(player_stats)
+    
+    
+    def player_left(self, user_id : int) -> None:
+        """Archives a player who left the ladder's server (any server for the default ladder)."""
+        self._solo_teams.pop(user_id, None)
+        for player_stats in (self.player_stats, self.player_stats_1v1):
+            if player_stats.has_account(user_id):
+                player_stats.archive(user_id)
+                print(f'Deleted player (id: {user_id}) since system cannot find them in the ladder\'s server.')
+    
+    
+    def player_joined(self, user_id : int) -> None:
+        """Returns an archived player to the ladders once they can be found again."""
+        for player_stats in (self.player_stats, self.player_stats_1v1):
+            if player_stats.is_archived(user_id):
+                player_stats.restore(user_id)
+                print(f'Returned player (id: {user_id}) to the player stats system since they can be found (previously they were missing).')
         
         
-    def _str_leaderboard(self, entries : int, player_stats : dict, description : str) -> str:
+    def _str_leaderboard(self, entries : int, player_stats : 'PlayerStatsRepository', description : str, start : int = 0) -> str:
         message_str = '```{:^30}\n'.format('~~~~~ {} LEADERBOARD ~~~~~'.format(description))
-        place = 1
-        for player in sorted(player_stats.items(), 
-                                    key = lambda player: player[1]['rating'], 
-                                    reverse=True):
-            if place >= entries + 1: break
+        place = start + 1
+        for user_id, rating in player_stats.top(entries, start):
             if (place - 1) % 10 == 0: message_str += '\n'
             try:
-                message_str += '{:<4}{:<30} {}\n'.format(place, self._find_user(player[0]).name, player[1]['rating'])
+                message_str += '{:<4}{:<30} {}\n'.format(place, self._find_user(user_id).name, rating)
             except UnicodeEncodeError:
                 continue
             
@@ -117,18 +174,37 @@ Thank you for using LadderManager.\n\n'''
         return message_str
     
     
-    def _generate_leaderboard(self, entries: int) -> str:
-        """Generates the leaderboard as a string, entries input determines
-           how many players are shown on the leaderboard."""
-        self._return_player_stats(self.player_stats, self._archived_player_stats)
-        self._filter_player_stats(self.player_stats, self._archived_player_stats)
+    def _cached_leaderboard(self, entries : int, page : int, mode : str,
+                            player_stats : 'PlayerStatsRepository', description : str) -> str:
+        """Returns a rendered leaderboard page, only rendering it again once a rating has changed.
+           mode is 'top' for the leaderboard command and 'full' for full_leaderboard pages."""
+        version, pages = self._rendered_leaderboards.get(player_stats.name, (None, None))
+        if version != player_stats.version:
+            pages = {}
+            self._rendered_leaderboards[player_stats.name] = (player_stats.version, pages)
+        
+        if (page, mode) not in pages:
+            with METRICS.timer('render', player_stats.name):
+                message_str = self._str_leaderboard(entries, player_stats, description, (page - 1) * entries)
+                if mode == 'full':
+                    message_str += '\nPage {} of {} ({}full_leaderboard <page>)'.format(
+                        page, self._leaderboard_pages(player_stats, entries), self.dynamic_options['command_symbol'])
+            pages[(page, mode)] = message_str
+        return pages[(page, mode)]
+    
+    
+    def _leaderboard_pages(self, player_stats : 'PlayerStatsRepository', entries : int) -> int:
+        return max(1, -(-player_stats.count() // entries))
+    
     
+    def _generate_leaderboard(self, entries: int, page : int = 1, mode : str = 'top') -> str:
+        """Generates the leaderboard as a string, entries input determines
+           how many players are shown on the leaderboard (per page)."""
         if self.dynamic_options['separate_1v1_mmr']:
-            self._return_player_stats(self.player_stats_1v1, self._archived_player_stats_1v1)
-            self._filter_player_stats(self.player_stats_1v1, self._archived_player_stats_1v1)
-            return self._str_leaderboard(entries, self.player_stats, 'General') + '\n' + self._str_leaderboard(entries, self.player_stats_1v1, '1v1')
+            return self._cached_leaderboard(entries, page, mode, self.player_stats, 'General') + '\n' + \
+                   self._cached_leaderboard(entries, page, mode, self.player_stats_1v1, '1v1')
         else:
-            return self._str_leaderboard(entries, self.player_stats, '')
+            return self._cached_leaderboard(entries, page, mode, self.player_stats, '')
         
         
     def get_num_top_leaderboard(self) -> int:
@@ -137,29 +213,32 @@ Thank you for using LadderManager.\n\n'''
     
     def leaderboard_option(self, message: discord.Message) -> base.DirectedMessage:
         """Default leaderboard command, displays the top self._num_top_leaderboard players (dynamic option)."""
-        entries = len(self.player_stats.keys()) if len(self.player_stats.keys()) < self.get_num_top_leaderboard() else self.get_num_top_leaderboard()
-        return base.DirectedMessage(self._generate_leaderboard(entries), message.channel)
+        return base.DirectedMessage(self._generate_leaderboard(self.get_num_top_leaderboard()), message.channel)
 
     
     def full_leaderboard_option(self, message: discord.Message) -> base.DirectedMessage:
-        """Displays all players in the ladder system."""
-        return base.DirectedMessage(self._generate_leaderboard(len(self.player_stats.keys())), message.author)
+        """Displays all players in the ladder system, leaderboard_page_size (dynamic option) at a time.
+           The page is the number at the end of the command, defaulting to the first."""
+        entries = self.dynamic_options['leaderboard_page_size']
+        page = re.search('([0-9]+)$', message.content.strip())
+        pages = max(self._leaderboard_pages(self.player_stats, entries),
+                    self._leaderboard_pages(self.player_stats_1v1, entries) if self.dynamic_options['separate_1v1_mmr'] else 1)
+        page = min(max(int(page.group(1)), 1), pages) if page else 1
+        return base.DirectedMessage(self._generate_leaderboard(entries, page, 'full'), message.author)
 
     
-    def _str_stats(self, user_id : int, player_stats : dict, description : str) -> str:
-        if self._has_account(user_id):
-            list_of_ratings = sorted([player['rating'] for player in player_stats.values()])
-            
-            place_on_leaderboard = len(list_of_ratings) - list_of_ratings.index(player_stats[user_id]['rating'])
+    def _str_stats(self, user_id : int, player_stats : 'PlayerStatsRepository', description : str) -> str:
+        if player_stats.has_account(user_id):
+            stats = player_stats.get(user_id)
                 
             string = '''```{name}\'s {description} stats\nRating: {rating}\nWins: {wins}\nLosses: {losses}\nPlace on leaderboard: {place} out of {total}```'''.format(
                                         name = self._find_user(user_id).name,
                                         description = description,
-                                        rating = player_stats[user_id]['rating'],
-                                        wins = player_stats[user_id]['wins'],
-                                        losses = player_stats[user_id]['losses'],
-                                        place = place_on_leaderboard,
-                                        total = len(list_of_ratings))
+                                        rating = stats['rating'],
+                                        wins = stats['wins'],
+                                        losses = stats['losses'],
+                                        place = player_stats.rank(user_id),
+                                        total = player_stats.count())
             return string
         else:
             return 'Player {} not found.'.format(self._find_user(
@@ -183,59 +262,99 @@ Thank you for using LadderManager.\n\n'''
 
     def stats_other_option(self, message:discord.Message) -> base.DirectedMessage:
         """Returns the stats of the player mentioned."""
-        return base.DirectedMessage(self._generate_stats(self._mention_strip(message.content)),
+        return base.DirectedMessage(self._generate_stats(self._mention_or_name_strip(message.content)),
                                 message.channel)
 
-    def _str_record(self, user_id : int, player_stats : dict, description : str) -> str:
-        if not self._has_account(user_id):
+    def _str_record(self, user_id : int, player_stats : 'PlayerStatsRepository', description : str,
+                    order : str = 'played', page : int = 1) -> str:
+        """One page of a player's records, record_page_size (dynamic option) opponents long so it fits in a message.
+           Only the requested page is sorted out of the records and only its opponents' names are resolved
+           (opponents that can't be found any more are left out of the page, they still count towards the pages)."""
+        if not player_stats.has_account(user_id):
             return 'Player {} does not have an account.'.format(self._find_user(user_id).name)
-        if 'records' not in player_stats[user_id]:
+        records = player_stats.get_records(user_id)
+        if not records:
             return 'The specified player does not have a record with other players.'
         
-        string = '{}\'s {} record against other players:\n\n'.format(self._find_user(user_id).name, description)
+        entries = self.dynamic_options['record_page_size']
+        pages = -(-len(records) // entries)
+        page = min(page, pages)
+        shown = heapq.nsmallest(page * entries, records.items(), key = RECORD_ORDERS[order])[(page - 1) * entries:]
+        opponents = self.user_index.get_many(opponent for opponent, _ in shown)
         
-        for opponent in player_stats[user_id]['records']:
-            opponent = self._find_user(opponent)
-            if opponent:
-                string += 'Against {op_name}\n\tWins: {wins}\n\tLosses: {losses}\n\n'.format(
-                    op_name = opponent.name,
-                    wins = player_stats[user_id]['records'][opponent.id]['wins'],
-                    losses = player_stats[user_id]['records'][opponent.id]['losses'])
+        string = '{}\'s {} record against other players ({}):\n\n'.format(self._find_user(user_id).name, description,
+                                                                          RECORD_ORDER_DESCRIPTIONS[order])
+        for opponent, record in shown:
+            if opponent not in opponents:
+                continue
+            string += 'Against {op_name}\n\tWins: {wins}\n\tLosses: {losses}\n\n'.format(
+                op_name = opponents[opponent].name,
+                wins = record['wins'],
+                losses = record['losses'])
+        string += 'Page {} of {} ({}record [player] [played/best/worst] <page>)\n'.format(
+            page, pages, self.dynamic_options['command_symbol'])
             
         return string
     
     
-    def _generate_record(self, user_id: int) -> str:
+    def _generate_record(self, user_id: int, order : str = 'played', page : int = 1) -> str:
         """Generates the record of a player against other players."""
         if self.dynamic_options['separate_1v1_mmr']:
-            return self._str_record(user_id, self.player_stats, 'general') + self._str_record(user_id, self.player_stats_1v1, '1v1')
+            return self._str_record(user_id, self.player_stats, 'general', order, page) + self._str_record(user_id, self.player_stats_1v1, '1v1', order, page)
         else:
-            return self._str_record(user_id, self.player_stats, 'general')
+            return self._str_record(user_id, self.player_stats, 'general', order, page)
+    
+    
+    def _record_options(self, content : str) -> (str, str, int):
+        """Splits "!record [player] [played/best/worst] [page]" into (the command without the options, order, page)."""
+        words = content.split()
+        page = 1
+        if len(words) > 1 and words[-1].isdigit():
+            page = max(1, int(words.pop()))
+        order = 'played'
+        if len(words) > 1 and words[-1].lower() in RECORD_ORDERS:
+            order = words.pop().lower()
+        return ' '.join(words), order, page
         
         
     def record_self_option(self, message: discord.Message) -> base.DirectedMessage:
         """Returns the record of the user who asked for it."""
-        return base.DirectedMessage(self._generate_record(message.author.id), message.author)
+        _, order, page = self._record_options(message.content)
+        return base.DirectedMessage(self._generate_record(message.author.id, order, page), message.author)
 
 
     def record_other_option(self, message: discord.Message) -> base.DirectedMessage:
         """Returns the record of the pinged player"""
-        return base.DirectedMessage(self._generate_record(self._mention_strip(message.content)), message.author)
+        content, order, page = self._record_options(message.content)
+        return base.DirectedMessage(self._generate_record(self._mention_or_name_strip(content), order, page), message.author)
     
     
     def _player_on_team(self, p_id : int) -> bool:
-        return p_id in self.teams and self.teams[p_id]
+        return self.team_registry.on_team(p_id)
     
     
     def _input_team_system(self, team : Team) -> None:
-        for player in team.get_players():
-            self.teams[player] = team
+        self.team_registry.add(team)
+        self._temporary_data_changed()
             
             
     def _team_remove(self, p_id : int) -> None:
-        team = self.teams[p_id]
-        team.remove(p_id)
-        del self.teams[p_id]
+        self.team_registry.remove_member(p_id)
+        self.expiry.cancel(('invite', p_id))
+        self._temporary_data_changed()
+    
+    
+    def _schedule_invite_expiry(self, p_id : int, deadline : float = None) -> None:
+        """Team invites nobody answers are withdrawn after the team_invite_timeout dynamic option."""
+        if self.dynamic_options['team_invite_timeout']:
+            self.expiry.schedule(('invite', p_id), deadline or time.time() + self.dynamic_options['team_invite_timeout'])
+    
+    
+    def _expire_team_invite(self, p_id : int) -> None:
+        team = self.teams.get(p_id)
+        if team is not None and p_id in team and not team.get_members_dict()[p_id][0]:
+            self._team_remove(p_id)
+            print(f'Team invite of player (id: {p_id}) expired.')
     
     #inefficient call? (self._find_user)
     def create_team_option(self, message: discord.Message) -> base.DirectedMessage:
@@ -248,6 +367,9 @@ Thank you for using LadderManager.\n\n'''
         if members:
             team = Team((message.author.id, self._find_user(message.author.id).name), *members)
             self._input_team_system(team)
+            for member in team.get_players():
+                if member != message.author.id:
+                    self._schedule_invite_expiry(member)
             
             return base.DirectedMessage('Successfully created team.', message.channel)
         else:
@@ -266,6 +388,7 @@ Thank you for using LadderManager.\n\n'''
                 user_name = self._find_user(user).display_name
                 invited.add(user_name)
                 team.invite(user, user_name)
+                self._schedule_invite_expiry(user)
             self._input_team_system(team)
             
             return base.DirectedMessage('Successfully invited the following players: {}. Any players not invited are already on a team.'.format(
@@ -285,6 +408,8 @@ Thank you for using LadderManager.\n\n'''
         if self._player_on_team(message.author.id):
             team = self.teams[message.author.id]
             team.update(message.author.id)
+            self.expiry.cancel(('invite', message.author.id))
+            self._temporary_data_changed()
             
             if team.get_acceptance():
                 return base.DirectedMessage('Team is fully ready to play!', message.channel)
@@ -304,23 +429,26 @@ Thank you for using LadderManager.\n\n'''
 
     
     def ongoing_option(self, message : discord.Message) -> base.DirectedMessage:
-        shown = set()
-        string = '`CHALLENGES`\n'
-        count = 1
-        for player in self.challenges:
-            challenge = self.challenges[player]
-            if challenge not in shown:
-                shown.add(challenge)
-                string += \
+        """Lists ongoing challenges a page at a time: !ongoing [accepted/pending] [page]."""
+        words = message.content.lower().split()
+        page = max(1, int(words.pop())) if len(words) > 1 and words[-1].isdigit() else 1
+        status = words[-1] if len(words) > 1 and words[-1] in ('accepted', 'pending') else 'all'
+        
+        entries = self.dynamic_options['ongoing_page_size']
+        pages = max(1, -(-self.challenge_registry.count(status) // entries))
+        page = min(page, pages)
+        string = '`CHALLENGES`\n' if status == 'all' else f'`{status.upper()} CHALLENGES`\n'
+        for challenge in self.challenge_registry.page(status, (page - 1) * entries, entries):
+            string += \
 '''Challenge #{count}:
         Challengers - {challengers}
         Challenged - {challenged}
-        Accepted - {bool_val}\n'''.format(count = count,
+        Accepted - {bool_val}\n'''.format(count = challenge.id,
                                               challengers = ', '.join(challenge.get_challenger_players_names()),
                                               challenged = ', '.join(challenge.get_challenged_players_names()),
                                               bool_val = challenge.accepted)
-                count += 1
-                
+        string += 'Page {} of {} ({}ongoing [accepted/pending] <page>)'.format(page, pages, self.dynamic_options['command_symbol'])
+        
         return base.DirectedMessage(string, message.channel)
     
     
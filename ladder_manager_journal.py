@@ -0,0 +1,143 @@
+import os
+import json
+import pickle
+import threading
+
+
+class MatchJournal():
+    """Write-ahead journal of reported matches on top of a periodic stats snapshot.
+        Every report appends one small record to the journal instead of re-pickling all
+        player stats; every snapshot_interval matches the stats are compacted into a new
+        snapshot and the journal starts over.
+        A snapshot taken while the bot runs (snapshot_later) is written off the event loop:
+        the journal it covers is moved aside to journal_path.old until the snapshot is on
+        disk, and new matches go to a fresh journal meanwhile. Loading reads both."""
+    def __init__(self, snapshot_path : str, journal_path : str, snapshot_interval : int):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.old_journal_path = journal_path + '.old'
+        self.snapshot_interval = snapshot_interval
+        self._seq = 0 #sequence number of the last match written (snapshotted or journaled)
+        self._snapshot_seq = 0
+        self._since_snapshot = 0
+        self._written_seq = 0 #sequence number of the snapshot on disk
+        self._writing = False #a snapshot_later write hasn't finished
+        self._write_lock = threading.Lock()
+
+
+    def load_snapshot(self) -> list:
+        """Returns the stats lists stored in the latest snapshot.
+            Raises the underlying exception if there is no usable snapshot."""
+        with open(self.snapshot_path, 'rb') as saveFile:
+            stats = pickle.load(saveFile)
+
+        if len(stats) % 2: #the sequence number is last (snapshots written before the journal existed have none)
+            self._snapshot_seq = self._written_seq = self._seq = stats.pop()
+        return stats
+
+
+    def load_journal(self) -> [dict]:
+        """Returns the journaled matches newer than the snapshot, oldest first (a journal moved
+            aside for a snapshot that never made it to disk first). A torn last line (crash
+            mid-append) is dropped and cut off the file."""
+        records = self._load_records(self.old_journal_path) + self._load_records(self.journal_path)
+        self._since_snapshot = len(records)
+        return records
+
+
+    def _load_records(self, path : str) -> [dict]:
+        records = []
+        valid_length = 0
+        try:
+            with open(path, 'rb') as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith(b'\n'):
+                        break
+                    valid_length += len(line)
+                    if record['seq'] > self._snapshot_seq:
+                        records.append(record)
+                        self._seq = record['seq']
+        except FileNotFoundError:
+            return records
+
+        if valid_length != os.path.getsize(path):
+            with open(path, 'r+b') as journal:
+                journal.truncate(valid_length)
+        return records
+
+
+    def has_old_journal(self) -> bool:
+        return os.path.exists(self.old_journal_path)
+
+
+    def append(self, record : dict, matches : int = 1) -> bool:
+        """Durably appends a match record (one line, holding matches matches).
+            Returns whether a snapshot is due."""
+        self._seq += 1
+        record['seq'] = self._seq
+        with open(self.journal_path, 'ab') as journal:
+            journal.write(json.dumps(record, separators = (',', ':')).encode() + b'\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        self._since_snapshot += matches
+        return self._since_snapshot >= self.snapshot_interval
+
+
+    def snapshot(self, stats : list) -> None:
+        """Atomically replaces the snapshot with stats, then empties the journal.
+            Records already covered by the snapshot are skipped on load if a crash
+            happens between the two steps."""
+        seq, data = self._seq, self._dump(stats)
+        with self._write_lock:
+            self._write_snapshot(seq, data)
+            open(self.journal_path, 'wb').close()
+            self._remove_old_journal()
+        self._since_snapshot = 0
+
+
+    def snapshot_later(self, stats : list) -> 'callable':
+        """Pickles stats now (so later changes can't leak in) and moves the journal aside, returns
+            the function that writes the snapshot, for an executor. Returns None while the last
+            one is still being written, the next append asks again."""
+        if self._writing:
+            return None
+        self._writing = True
+        seq, data = self._seq, self._dump(stats)
+        os.replace(self.journal_path, self.old_journal_path)
+        self._since_snapshot = 0
+
+        def write() -> None:
+            try:
+                with self._write_lock:
+                    if seq > self._written_seq: #else a snapshot() since has covered it already
+                        self._write_snapshot(seq, data)
+                        self._remove_old_journal()
+            finally:
+                self._writing = False
+        return write
+
+
+    def _dump(self, stats : list) -> bytes:
+        return pickle.dumps(list(stats) + [self._seq])
+
+
+    def _write_snapshot(self, seq : int, data : bytes) -> None:
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as saveFile:
+            saveFile.write(data)
+            saveFile.flush()
+            os.fsync(saveFile.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self._snapshot_seq = self._written_seq = seq
+
+
+    def _remove_old_journal(self) -> None:
+        try:
+            os.remove(self.old_journal_path)
+        except FileNotFoundError:
+            pass
@@ -1,4 +1,8 @@
+import os
+import json
+import time
 import pickle
+import asyncio
 
 import discord
 
@@ -6,119 +10,233 @@ from  ladder_manager_commands import match_command
 import ladder_manager_base as base
 from ladder_manager_information import InformationCommands
 from ladder_manager_challenges import ChallengeCommands
+from ladder_manager_users import UserIndex
+from ladder_manager_storage import open_storage
+from ladder_manager_history import MatchHistory
+from ladder_manager_persistence import SaveScheduler, BufferedAppender
+from ladder_manager_outbound import MessageDispatcher
+from ladder_manager_metrics import METRICS
+from ladder_manager_guilds import GuildLadders
+from ladder_manager_expiry import ExpiryScheduler
+from ladder_manager_challenges import ChallengeRegistry
 from dynamic_options import DYNAMIC_OPTIONS, ESSENTIAL_OPTIONS
 
-client = discord.Client()
+def create_client(dynamic_options : dict) -> discord.AutoShardedClient:
+    """Sharded client. By default one process runs every shard; shard_ids and shard_count
+       split the guilds over several processes (each only loads its own guilds' ladders)."""
+    if dynamic_options['shard_ids'] is not None:
+        return discord.AutoShardedClient(shard_count = dynamic_options['shard_count'],
+                                         shard_ids = dynamic_options['shard_ids'])
+    return discord.AutoShardedClient(shard_count = dynamic_options['shard_count'])
+
+
+client = create_client(DYNAMIC_OPTIONS)
 ################################################################################
 ################################################################################
 ################################################################################
 '''
+self.player_stats and self.player_stats_1v1 are PlayerStatsRepository objects
+(see ladder_manager_storage). The pickle storage backend keeps each ladder in a
+dictionary like this one:
+
 Player_stats dictionary description:
-self.player_stats = {user_id: {'rating': int,
-                            'wins': int,
-                            'losses': int,
-                            'records': {user_id: {'wins': int,
-                                                  'losses': int}
-                                        ...}
-                        }
+self.player_stats = {user_id: PlayerStats(rating = int,
+                                          wins = int,
+                                          losses = int)
                 ...
             }
+
+Head-to-head records are kept once per pair of players in a HeadToHead store
+(see ladder_manager_records) next to it. Snapshots written before PlayerStats held
+{'rating', 'wins', 'losses', 'records'} dicts instead, they're converted when loaded.
 '''
 
 class LadderManager(InformationCommands,
                     base.BaseCommands,
                     ChallengeCommands):
-    """Inherits all ladder commands and functions, holds several key
-       global variables."""
-    def __init__(self, client : 'discord.Client()'):
+    """Inherits all ladder commands and functions, holds the state of one guild's ladder
+       (see GuildLadders), kept in directory."""
+    def __init__(self, client : 'discord.Client()', user_index : UserIndex, guild_id : int = None, directory : str = '.'):
         """Loads client and player stats."""
         self.client = client
-        self.player_stats = {} #used if first time
-        self._archived_player_stats = {} #used if first time
-        self.player_stats_1v1 = {} #used if first time
-        self._archived_player_stats_1v1 = {} #used if first time
-        
+        self.user_index = user_index
+        self.guild_id = guild_id
+        self.directory = directory
         self.teams = {}
         self.challenges = {}
+        self._rendered_leaderboards = {} #ladder name: (ladder version, {(page, mode): leaderboard string})
         
         self.dynamic_options = DYNAMIC_OPTIONS
         self.version = self.dynamic_options['version']
-        try:
-            with open('laddermanager.pkl', 'rb') as saveFile:
-                    self.player_stats, self._archived_player_stats, self.player_stats_1v1, self._archived_player_stats_1v1 = pickle.load(saveFile)
-        except Exception as e:
-            print(
-f'''Player stats could not be loaded, exception: {e}.
-This should happen first time you run the bot.
-If this is not your first run, try rebooting the bot.
-If the problem persists contact Antis.''')
+        self.storage = open_storage(self.dynamic_options, os.path.join(directory, 'laddermanager.pkl'),
+                                    os.path.join(directory, 'laddermanager_journal.log'),
+                                    os.path.join(directory, 'laddermanager.db'))
+        self.player_stats = self.storage.ladder('general')
+        self.player_stats_1v1 = self.storage.ladder('1v1')
+        self.match_history = MatchHistory(os.path.join(directory, 'laddermanager_history.bin'))
         
+        deadlines = {}
         try:
-            with open('laddermanager_tmp.pkl', 'rb') as saveFile_tmp:
-                self.teams, self.challenges = pickle.load(saveFile_tmp)
+            with open(os.path.join(directory, 'laddermanager_tmp.pkl'), 'rb') as saveFile_tmp:
+                saved = pickle.load(saveFile_tmp)
+            self.teams, self.challenges = saved[:2]
+            if len(saved) > 2: #files saved before challenges and invites expired have no deadlines
+                deadlines = saved[2]
         except Exception as e:
             print(f'''Temporary data could not be loaded, exception : {e}.''')
+        self.team_registry = base.TeamRegistry(self.teams)
+        self._solo_teams = {} #user_id: Team of just them, for challenges of players without a team
+        self.challenge_registry = ChallengeRegistry(set(self.challenges.values()))
+        self.expiry = ExpiryScheduler(self._expire)
+        self._restore_expiries(deadlines)
+        self.save_scheduler = SaveScheduler(os.path.join(directory, 'laddermanager_tmp.pkl'),
+                                            lambda: [self.teams, self.challenges, self.expiry.deadlines],
+                                            self.dynamic_options['save_delay'])
+
 
+dispatcher = MessageDispatcher(DYNAMIC_OPTIONS['coalesce_window'],
+                               DYNAMIC_OPTIONS['channel_messages_per_second'],
+                               DYNAMIC_OPTIONS['channel_message_burst'])
 
 async def send_message(message : base.DirectedMessage) -> None:
-        """Sends a message to a channel.
-            If channel is none, sends a message to the DM channel of the author."""
-        if type(message.channel) == discord.User:
-            if message.channel.dm_channel == None: await message.channel.create_dm()
-            await message.channel.dm_channel.send(message.message)
-        else:
-            await message.channel.send(message.message)
+        """Sends a message to a channel (queued, see MessageDispatcher).
+            If channel is a user, sends a message to the DM channel of that user."""
+        await dispatcher.send(message)
+
+
+async def write_metrics_periodically(path : str, interval : float) -> None:
+    """Keeps the prometheus metrics file fresh for a local scraper (written on an executor)."""
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await loop.run_in_executor(None, METRICS.write_prometheus, path, METRICS.prometheus_text())
+        except Exception as e: #keep the writer alive, a failed write is retried next interval
+            print(f'Metrics could not be written, exception : {e}.')
+
 
+async def evict_idle_ladders_periodically(interval : float) -> None:
+    """Unloads ladders nobody has used for ladder_idle_timeout seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        ladders.evict_idle()
 
-ladder = LadderManager(client)
 
-@ladder.client.event
+user_index = UserIndex(client)
+ladders = None #GuildLadders, created by setup
+message_trace = None #BufferedAppender of message_trace_file, created by setup
+metrics_writer = None
+ladder_evictor = None
+
+@client.event
 async def on_ready():
-    print(f"Logged in as {ladder.client.user}")
+    global metrics_writer, ladder_evictor
+    if not ladders.adopt_legacy_ladder(guild.id for guild in client.guilds):
+        await client.close()
+        return
+    user_index.rebuild()
+    ladders.reconcile = True #ladders are loaded by their first command from now on
+    for ladder in ladders.all_loaded():
+        ladder.reconcile_player_stats()
+    if metrics_writer is None and DYNAMIC_OPTIONS['metrics_file']: #on_ready fires again after reconnects
+        metrics_writer = asyncio.ensure_future(write_metrics_periodically(DYNAMIC_OPTIONS['metrics_file'],
+                                                                          DYNAMIC_OPTIONS['metrics_interval']))
+    if ladder_evictor is None and DYNAMIC_OPTIONS['ladder_idle_timeout']:
+        ladder_evictor = asyncio.ensure_future(evict_idle_ladders_periodically(DYNAMIC_OPTIONS['ladder_idle_timeout'] / 2))
+    print(f"Logged in as {client.user}")
+
+
+@client.event
+async def on_member_join(member):
+    user_index.add(member)
+    ladders.member_joined(member)
+
+
+@client.event
+async def on_member_remove(member):
+    ladders.member_left(member, user_index.remove(member.id))
+
+
+@client.event
+async def on_member_update(before, after):
+    user_index.add(after)
+
+
+@client.event
+async def on_user_update(before, after):
+    user_index.add(after) #username changes arrive here, not in on_member_update
     
 
-POSSIBLE_COMMANDS = {'help': ladder.help_option,
-                         'about': ladder.about_option,
-                         'leaderboard': ladder.leaderboard_option,
-                         'full_leaderboard': ladder.full_leaderboard_option,
-                         'stats_self': ladder.stats_self_option,
-                         'stats_other': ladder.stats_other_option,
-                         'record_self': ladder.record_self_option,
-                         'record_other': ladder.record_other_option,
-                         'rules': ladder.rules_option,
-                         'ongoing': ladder.ongoing_option,
-                         
-                         'challenge': ladder.challenge_option,
-                         'accept_challenge': ladder.accept_challenge_option,
-                         'report_challenge': ladder.report_challenge_option,
-                         'decline_challenge': ladder.decline_challenge_option,
-                         'cancel_challenge': ladder.cancel_challenge_option,
-                         
-                         'create_team': ladder.create_team_option,
-                         'accept_team': ladder.accept_team_option,
-                         'leave_team': ladder.leave_team_option,
-                         'invite_team': ladder.invite_team_option,
-                         'status_team': ladder.status_team_option,
-                         
-                         'antis': ladder.antis_option}
-
-
-#unnecessary
-def _save_temporary_data(ladder : LadderManager) -> None:
-    """This is kinda inefficient to do every time a command is called 
-    but just trying to do a quick fix to my own issue of walking around."""
-    teams = ladder.teams
-    challenges = ladder.challenges
-    with open('laddermanager_tmp.pkl', 'wb') as saveFile:
-                pickle.dump([teams, challenges], saveFile)
-
-
-@ladder.client.event
+#command name (see ladder_manager_commands): handler, called with the ladder of the message's guild
+POSSIBLE_COMMANDS = {'help': LadderManager.help_option,
+                     'about': LadderManager.about_option,
+                     'leaderboard': LadderManager.leaderboard_option,
+                     'full_leaderboard': LadderManager.full_leaderboard_option,
+                     'stats_self': LadderManager.stats_self_option,
+                     'stats_other': LadderManager.stats_other_option,
+                     'record_self': LadderManager.record_self_option,
+                     'record_other': LadderManager.record_other_option,
+                     'rules': LadderManager.rules_option,
+                     'ongoing': LadderManager.ongoing_option,
+                     
+                     'challenge': LadderManager.challenge_option,
+                     'accept_challenge': LadderManager.accept_challenge_option,
+                     'report_challenge': LadderManager.report_challenge_option,
+                     'bulk_report': LadderManager.bulk_report_option,
+                     'decline_challenge': LadderManager.decline_challenge_option,
+                     'cancel_challenge': LadderManager.cancel_challenge_option,
+                     
+                     'create_team': LadderManager.create_team_option,
+                     'accept_team': LadderManager.accept_team_option,
+                     'leave_team': LadderManager.leave_team_option,
+                     'invite_team': LadderManager.invite_team_option,
+                     'status_team': LadderManager.status_team_option,
+                     
+                     'metrics': LadderManager.metrics_option,
+                     
+                     'antis': LadderManager.antis_option}
+
+
+def record_message(trace : BufferedAppender, message : discord.Message) -> None:
+    """Adds a message to a trace that ladder_manager_replay can play back (written in batches, see BufferedAppender)."""
+    trace.append(json.dumps({'time': time.time(), 'author': message.author.id, 'name': message.author.name,
+                             'channel': message.channel.id, 'content': message.content}) + '\n')
+
+
+@client.event
 async def on_message(message):
+    if message_trace is not None:
+        record_message(message_trace, message)
+    start = time.perf_counter()
     command = match_command(message)
+    METRICS.observe('match_command', time.perf_counter() - start)
     if command:
-        await send_message(POSSIBLE_COMMANDS[command.command_name](message))
-        _save_temporary_data(ladder)
-
-
-ladder.client.run(ESSENTIAL_OPTIONS['token'])
+        await ladders.unloaded(message)
+        with METRICS.timer('handler', command.command_name), ladders.in_use(ladders.for_message(message)) as ladder:
+            reply = POSSIBLE_COMMANDS[command.command_name](ladder, message)
+            if asyncio.iscoroutine(reply): #handlers that wait on I/O (attachment downloads, the metrics file)
+                reply = await reply
+        with METRICS.timer('send', command.command_name):
+            await send_message(reply)
+
+
+def setup(bot_client : 'discord.Client()') -> GuildLadders:
+    """Prepares the ladders the events above work on. Offline tools (benchmarks,
+       trace replays) pass a fake client and call the events themselves, which then use it."""
+    global client, user_index, ladders, message_trace
+    client = bot_client
+    message_trace = (BufferedAppender(DYNAMIC_OPTIONS['message_trace_file'], DYNAMIC_OPTIONS['message_trace_interval'])
+                     if DYNAMIC_OPTIONS['message_trace_file'] else None)
+    user_index = UserIndex(bot_client)
+    ladders = GuildLadders(lambda guild_id, directory: LadderManager(bot_client, user_index, guild_id, directory),
+                           DYNAMIC_OPTIONS['ladders_directory'], DYNAMIC_OPTIONS['default_guild_id'],
+                           DYNAMIC_OPTIONS['max_loaded_ladders'], DYNAMIC_OPTIONS['ladder_idle_timeout'])
+    return ladders
+
+
+if __name__ == '__main__':
+    setup(client)
+    client.run(ESSENTIAL_OPTIONS['token'])
+    ladders.close()
+    if message_trace is not None:
+        message_trace.flush()
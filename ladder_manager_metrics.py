@@ -0,0 +1,94 @@
+import os
+import time
+import bisect
+from contextlib import contextmanager
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) #seconds
+
+
+class Histogram():
+    """Counts observations per latency bucket (the last count is for anything above BUCKETS[-1])."""
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+
+    def observe(self, seconds : float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+
+    def quantile(self, q : float) -> float:
+        """Upper bound of the bucket holding the q-th quantile (inf if it's past the last bucket)."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics():
+    """Latency histograms for the stages of on_message, keyed by (stage, name).
+        Stages are match_command, handler and send (name is the POSSIBLE_COMMANDS key),
+        persistence (name is what was written) and discord_send."""
+    def __init__(self):
+        self._histograms = {}
+
+
+    def observe(self, stage : str, seconds : float, name : str = '') -> None:
+        key = (stage, name)
+        if key not in self._histograms:
+            self._histograms[key] = Histogram()
+        self._histograms[key].observe(seconds)
+
+
+    @contextmanager
+    def timer(self, stage : str, name : str = ''):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, name)
+
+
+    def summary(self) -> str:
+        """Human readable table for the metrics command."""
+        lines = [f'{"stage":<14}{"name":<18}{"count":>8}{"mean ms":>10}{"p50 ms":>9}{"p99 ms":>9}']
+        for (stage, name), histogram in sorted(list(self._histograms.items())): #copied at once, executor threads add keys too
+            lines.append(f'{stage:<14}{name:<18}{histogram.count:>8}'
+                         f'{1000 * histogram.total / histogram.count:>10.2f}'
+                         f'{1000 * histogram.quantile(0.5):>9.1f}{1000 * histogram.quantile(0.99):>9.1f}')
+        return '\n'.join(lines)
+
+
+    def prometheus_text(self) -> str:
+        """Prometheus text exposition format. Build it on the event loop, handlers add histograms there."""
+        lines = ['# HELP laddermanager_stage_seconds Time spent in each stage of handling a message.',
+                 '# TYPE laddermanager_stage_seconds histogram']
+        for (stage, name), histogram in sorted(list(self._histograms.items())):
+            labels = f'stage="{stage}",name="{name}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f'laddermanager_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'laddermanager_stage_seconds_sum{{{labels}}} {histogram.total}')
+            lines.append(f'laddermanager_stage_seconds_count{{{labels}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+    def write_prometheus(self, path : str, text : str = None) -> None:
+        """Atomically replaces path with text (from prometheus_text, the current metrics if None)
+        for a local scraper to read. Pass the text when writing on an executor."""
+        if text is None:
+            text = self.prometheus_text()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(text)
+        os.replace(tmp_path, path)
+
+
+METRICS = Metrics()
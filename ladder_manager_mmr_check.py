@@ -0,0 +1,87 @@
+'''Differential check of mmr_calculator and mmr_calculator_batch against the original
+per-game loop. Run it after touching the rating code:
+
+    python ladder_manager_mmr_check.py [number of random matches]
+
+Exits with status 1 and prints the first mismatches if any result differs.'''
+import sys
+import random
+
+import ladder_manager_base as base
+from ladder_manager_base import WIN, LOSS
+
+
+def reference_mmr_calculator(base_rating_change : int, prediction_difference : int,
+                             player1mmr : int, player2mmr : int, match_sets : (WIN or LOSS, int)):
+    """mmr_calculator as it was before the per-set fast path, one loop iteration per game."""
+    p1wins = p2wins = 0
+    for outcome, amount in match_sets:
+        if outcome == WIN:
+            p1wins += amount
+        else:
+            p2wins += amount
+
+        for _ in range(amount):
+
+            rating_difference = abs(player1mmr - player2mmr)//prediction_difference
+
+            if rating_difference > base_rating_change: rating_difference = base_rating_change #make sure there isn't negative mmr change
+
+            player_favored = 1 if player1mmr >= player2mmr else -1
+
+            mmr_change = (base_rating_change + rating_difference * player_favored * -outcome) + 1
+
+            player1mmr += mmr_change * outcome
+            player2mmr += mmr_change * -outcome
+
+    return (player1mmr, player2mmr, p1wins, p2wins)
+
+
+def random_case(rng : random.Random) -> (int, int, int, int, [(int, int)]):
+    """Mixes ordinary ladder values with tiny/huge options, long sets and rating gaps
+    far past the clamp of rating_difference to base_rating_change."""
+    base_rating_change = rng.choice((0, 1, 2, 5, 25, 25, 40, rng.randint(0, 200)))
+    prediction_difference = rng.choice((1, 2, 7, 25, 25, 100, rng.randint(1, 1000)))
+    player1mmr = rng.randint(0, 4000)
+    player2mmr = player1mmr + rng.choice((0, 1, -1, rng.randint(-100, 100), rng.randint(-5000, 5000)))
+    match_sets = [(rng.choice((WIN, LOSS)), rng.choice((1, 2, 3, 9, rng.randint(1, 300))))
+                  for _ in range(rng.randint(0, 6))]
+    return base_rating_change, prediction_difference, player1mmr, player2mmr, match_sets
+
+
+def check(matches : int = 20000, seed : int = 0) -> [str]:
+    """Returns a description of every mismatch found."""
+    rng = random.Random(seed)
+    cases = [random_case(rng) for _ in range(matches)]
+    mismatches = []
+
+    for case in cases:
+        expected = reference_mmr_calculator(*case)
+        actual = base.mmr_calculator(*case)
+        if actual != expected:
+            mismatches.append(f'mmr_calculator{case}: {actual} != {expected}')
+
+    by_options = {}
+    for base_rating_change, prediction_difference, player1mmr, player2mmr, match_sets in cases:
+        by_options.setdefault((base_rating_change, prediction_difference), []).append((player1mmr, player2mmr, match_sets))
+    for (base_rating_change, prediction_difference), group in by_options.items():
+        player1mmrs, player2mmrs, match_sets_list = zip(*group)
+        batch = base.mmr_calculator_batch(base_rating_change, prediction_difference,
+                                          player1mmrs, player2mmrs, match_sets_list)
+        for match, (player1mmr, player2mmr, match_sets) in enumerate(group):
+            expected = reference_mmr_calculator(base_rating_change, prediction_difference,
+                                                player1mmr, player2mmr, match_sets)
+            actual = tuple(column[match] for column in batch)
+            if actual != expected:
+                mismatches.append(f'mmr_calculator_batch{(base_rating_change, prediction_difference, player1mmr, player2mmr, match_sets)}: {actual} != {expected}')
+
+    return mismatches
+
+
+if __name__ == '__main__':
+    matches = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    mismatches = check(matches)
+    for mismatch in mismatches[:20]:
+        print(mismatch)
+    print(f'{len(mismatches)} mismatches in {matches} random matches (numpy {"on" if base.numpy else "off"}).')
+    sys.exit(1 if mismatches else 0)
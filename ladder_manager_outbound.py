@@ -0,0 +1,137 @@
+import asyncio
+from collections import deque
+
+import discord
+
+import ladder_manager_base as base
+from ladder_manager_metrics import METRICS
+
+MESSAGE_LIMIT = 2000 #discord's maximum message length
+MAX_RETRIES = 5 #attempts at a send that keeps getting rate limited (429) before dropping it
+
+
+class TokenBucket():
+    """Allows rate sends per second on average, with bursts of up to capacity."""
+    def __init__(self, rate : float, capacity : int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = None
+
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            now = loop.time()
+            if self._updated is not None:
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+    def is_full(self) -> bool:
+        """Whether the bucket has refilled completely, so a new bucket would behave the same."""
+        if self._updated is None:
+            return True
+        elapsed = asyncio.get_event_loop().time() - self._updated
+        return self._tokens + elapsed * self.rate >= self.capacity
+
+
+class MessageDispatcher():
+    """Queues outgoing messages per channel instead of awaiting each send inside on_message.
+        Each channel gets a worker that drains its queue through a token bucket, joins replies
+        that arrive within coalesce_window into one message (up to discord's size limit) and
+        backs off when discord answers with 429. DM channels are cached by user id.
+        A channel's bucket and cached DM channel are dropped once its queue has drained and
+        the bucket refilled, so only channels with recent traffic are kept."""
+    def __init__(self, coalesce_window : float, rate : float, burst : int):
+        self.coalesce_window = coalesce_window
+        self.rate = rate
+        self.burst = burst
+        self._queues = {} #channel id: deque of strings
+        self._workers = {} #channel id: worker future, only while the queue has messages
+        self._buckets = {} #channel id: TokenBucket
+        self._dm_channels = {} #user id: DMChannel
+        self._dm_users = {} #DMChannel id: user id, to drop _dm_channels entries with the channel
+
+
+    async def send(self, message : base.DirectedMessage) -> None:
+        """Queues a message, returning as soon as its channel is known."""
+        channel = await self._resolve_channel(message.channel)
+        if channel.id not in self._queues:
+            self._queues[channel.id] = deque()
+        if channel.id not in self._buckets:
+            self._buckets[channel.id] = TokenBucket(self.rate, self.burst)
+        self._queues[channel.id].append(message.message)
+
+        if channel.id not in self._workers:
+            self._workers[channel.id] = asyncio.ensure_future(self._drain(channel))
+
+
+    async def join(self) -> None:
+        """Waits until every queued message has been sent (or dropped)."""
+        while self._workers:
+            await asyncio.wait(list(self._workers.values()))
+
+
+    async def _resolve_channel(self, channel : 'discord.abc.Messageable') -> 'discord.abc.Messageable':
+        if not isinstance(channel, (discord.User, discord.Member)):
+            return channel
+        if channel.id not in self._dm_channels:
+            dm_channel = channel.dm_channel or await channel.create_dm()
+            self._dm_channels[channel.id] = dm_channel
+            self._dm_users[dm_channel.id] = channel.id
+        return self._dm_channels[channel.id]
+
+
+    async def _drain(self, channel : 'discord.abc.Messageable') -> None:
+        queue = self._queues[channel.id]
+        try:
+            while queue:
+                await asyncio.sleep(self.coalesce_window) #let replies to the same burst of commands pile up
+                await self._buckets[channel.id].acquire()
+                await self._send_with_backoff(channel, self._coalesce(queue))
+        finally:
+            del self._workers[channel.id]
+            if not queue:
+                del self._queues[channel.id]
+                asyncio.get_event_loop().call_later(self.burst / self.rate, self._forget_if_idle, channel.id)
+
+
+    def _forget_if_idle(self, channel_id : int) -> None:
+        """Drops the bucket (and cached DM channel) of a channel with nothing queued once its bucket is full."""
+        if channel_id in self._queues or channel_id not in self._buckets:
+            return
+        if not self._buckets[channel_id].is_full(): #sent again since, a later drain checks again
+            return
+        del self._buckets[channel_id]
+        user_id = self._dm_users.pop(channel_id, None)
+        if user_id is not None:
+            self._dm_channels.pop(user_id, None)
+
+
+    def _coalesce(self, queue : deque) -> str:
+        """Pops the first queued message plus as many following ones as fit in one message."""
+        text = queue.popleft()
+        while queue and len(text) + 1 + len(queue[0]) <= MESSAGE_LIMIT:
+            text += '\n' + queue.popleft()
+        return text
+
+
+    async def _send_with_backoff(self, channel : 'discord.abc.Messageable', text : str) -> None:
+        delay = 1 / self.rate
+        for _ in range(MAX_RETRIES):
+            try:
+                with METRICS.timer('discord_send'):
+                    await channel.send(text)
+                return
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    print(f'Could not send a message to channel {channel.id}, exception: {e}.')
+                    return
+                await asyncio.sleep(delay)
+                delay *= 2
+        print(f'Dropped a message to channel {channel.id} after being rate limited {MAX_RETRIES} times.')
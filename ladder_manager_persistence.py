@@ -0,0 +1,123 @@
+import os
+import pickle
+import asyncio
+import threading
+
+from ladder_manager_metrics import METRICS
+
+
+class SaveScheduler():
+    """Coalesces saves of state that changes often (teams and challenges).
+        Command handlers call mark_dirty; the state is pickled at most once per
+        delay window and written to disk on an executor so the event loop never
+        waits on the file system. flush writes anything still pending (shutdown)."""
+    def __init__(self, path : str, get_state : 'callable', delay : float):
+        self.path = path
+        self._get_state = get_state
+        self.delay = delay
+        self._dirty = False
+        self._handle = None
+        self._generation = 0 #bumped for every snapshot of the state taken
+        self._written_generation = 0
+        self._write_lock = threading.Lock()
+
+
+    def mark_dirty(self) -> None:
+        self._dirty = True
+        if self._handle is not None:
+            return
+
+        loop = asyncio.get_event_loop()
+        if loop.is_running():
+            self._handle = loop.call_later(self.delay, self._save_in_background, loop)
+        else: #no loop to defer to (eg. offline tools), save right away
+            self.flush()
+
+
+    def flush(self) -> None:
+        """Synchronously writes pending state, cancelling any scheduled save. A save still
+        running on the executor is superseded, so the file is current once flush returns."""
+        self.cancel()
+        if self._dirty or self._generation > self._written_generation:
+            self._write(*self._take_snapshot())
+
+
+    def cancel(self) -> None:
+        """Cancels the scheduled save (on the loop thread) without writing, flush still writes everything
+        pending. Lets the final flush of an unloaded ladder run off the loop (see GuildLadders._unload)."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+
+    def _save_in_background(self, loop : asyncio.AbstractEventLoop) -> None:
+        self._handle = None
+        if self._dirty:
+            loop.run_in_executor(None, self._write, *self._take_snapshot())
+
+
+    def _take_snapshot(self) -> (int, bytes):
+        """Pickles the state on the loop thread so handlers can't mutate it mid-write."""
+        self._dirty = False
+        self._generation += 1
+        with METRICS.timer('persistence', 'pickle_tmp'):
+            return self._generation, pickle.dumps(self._get_state())
+
+
+    def _write(self, generation : int, data : bytes) -> None:
+        with self._write_lock, METRICS.timer('persistence', 'write_tmp'):
+            if generation <= self._written_generation: #a newer snapshot already made it to disk
+                return
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as saveFile:
+                saveFile.write(data)
+            os.replace(tmp_path, self.path)
+            self._written_generation = generation
+
+
+class BufferedAppender():
+    """Appends lines to a file (eg. the message trace) without the event loop touching the disk.
+        append only buffers; the buffer is written on an executor at most once per delay
+        window, batches in the order they were taken. flush writes what's left (shutdown)."""
+    def __init__(self, path : str, delay : float):
+        self.path = path
+        self.delay = delay
+        self._lines = []
+        self._handle = None
+        self._buffer_lock = threading.Lock() #guards _lines between the loop and the executor
+        self._write_lock = threading.Lock() #one batch is written at a time, in order
+
+
+    def append(self, line : str) -> None:
+        with self._buffer_lock:
+            self._lines.append(line)
+        if self._handle is not None:
+            return
+
+        loop = asyncio.get_event_loop()
+        if loop.is_running():
+            self._handle = loop.call_later(self.delay, self._write_in_background, loop)
+        else: #no loop to defer to (eg. offline tools), write right away
+            self.flush()
+
+
+    def flush(self) -> None:
+        """Synchronously writes the buffered lines, cancelling any scheduled write."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._write()
+
+
+    def _write_in_background(self, loop : asyncio.AbstractEventLoop) -> None:
+        self._handle = None
+        loop.run_in_executor(None, self._write)
+
+
+    def _write(self) -> None:
+        with self._write_lock:
+            with self._buffer_lock:
+                lines, self._lines = self._lines, []
+            if lines:
+                with open(self.path, 'a') as appended:
+                    appended.write(''.join(lines))
@@ -0,0 +1,46 @@
+import bisect
+
+
+class RankIndex():
+    """Players kept sorted by rating (highest first, ties broken by user id) in a bisectable array.
+        Rank lookups are O(log n), the top k players are an O(k) slice, and because ties are
+        always ordered the same way a player's rank matches their leaderboard position."""
+    def __init__(self, ratings : [(int, int)] = ()):
+        self._ratings = dict(ratings) #user_id: rating
+        self._keys = sorted((-rating, user_id) for user_id, rating in self._ratings.items())
+        self.version = 0 #bumped whenever the order of players changes
+
+
+    def __len__(self):
+        return len(self._keys)
+
+
+    def __contains__(self, user_id):
+        return user_id in self._ratings
+
+
+    def add(self, user_id : int, rating : int) -> None:
+        """Adds a player, or moves them if they are already indexed."""
+        if user_id in self._ratings:
+            self.remove(user_id)
+        self._ratings[user_id] = rating
+        bisect.insort(self._keys, (-rating, user_id))
+        self.version += 1
+
+
+    def remove(self, user_id : int) -> None:
+        rating = self._ratings.pop(user_id)
+        del self._keys[bisect.bisect_left(self._keys, (-rating, user_id))]
+        self.version += 1
+
+
+    def rank(self, user_id : int) -> int:
+        """Returns the player's 1-based place, or None if they aren't indexed."""
+        if user_id not in self._ratings:
+            return None
+        return bisect.bisect_left(self._keys, (-self._ratings[user_id], user_id)) + 1
+
+
+    def top(self, count : int, start : int = 0) -> [(int, int)]:
+        """Returns (user_id, rating) for count players from place start + 1 down."""
+        return [(user_id, -rating) for rating, user_id in self._keys[start:start + count]]
@@ -0,0 +1,62 @@
+from array import array
+
+
+def pair_key(player : int, opponent : int) -> int:
+    """Key of an unordered pair of user ids (discord ids fit in 64 bits)."""
+    return min(player, opponent) << 64 | max(player, opponent)
+
+
+class HeadToHead():
+    """Head-to-head records of one ladder, stored once per unordered pair of players.
+        A pair's value is the lower id's wins << 32 | the higher id's wins, so a result
+        is one dictionary update and a lookup from either side is one dictionary read.
+        Each player's opponents are indexed so a player's records don't need a scan."""
+    def __init__(self, pairs : {int: int} = None):
+        self.pairs = pairs if pairs is not None else {}
+        self._opponents = {} #user_id: array of opponent ids
+        for key in self.pairs:
+            self._index(key >> 64, key & 0xFFFFFFFFFFFFFFFF)
+
+
+    def __len__(self):
+        return len(self.pairs)
+
+
+    def add(self, player : int, opponent : int, wins : int, losses : int) -> None:
+        """Adds wins and losses of player against opponent to their record."""
+        if player == opponent:
+            return
+        key = pair_key(player, opponent)
+        if player > opponent:
+            wins, losses = losses, wins
+        if key not in self.pairs:
+            self.pairs[key] = 0
+            self._index(player, opponent)
+        self.pairs[key] += wins << 32 | losses
+
+
+    def get(self, player : int, opponent : int) -> (int, int):
+        """Returns player's (wins, losses) against opponent, or None if they never played."""
+        value = self.pairs.get(pair_key(player, opponent))
+        if value is None:
+            return None
+        low_wins, high_wins = value >> 32, value & 0xFFFFFFFF
+        return (low_wins, high_wins) if player < opponent else (high_wins, low_wins)
+
+
+    def opponents(self, player : int) -> [int]:
+        return list(self._opponents.get(player, ()))
+
+
+    def records(self, player : int) -> {int: dict}:
+        """Returns {opponent_id: {'wins': int, 'losses': int}} for a player."""
+        records = {}
+        for opponent in self._opponents.get(player, ()):
+            wins, losses = self.get(player, opponent)
+            records[opponent] = {'wins': wins, 'losses': losses}
+        return records
+
+
+    def _index(self, player : int, opponent : int) -> None:
+        self._opponents.setdefault(player, array('Q')).append(opponent)
+        self._opponents.setdefault(opponent, array('Q')).append(player)
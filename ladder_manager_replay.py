@@ -0,0 +1,259 @@
+'''Replays a stream of chat messages through on_message against a fake gateway (see
+ladder_manager_fakes), persistence included, to load test the whole command path
+and check that it's deterministic.
+
+    python ladder_manager_replay.py --generate 20000 --rate 50 --speed 10 --runs 2
+    python ladder_manager_replay.py --trace laddermanager_trace.jsonl --state backup/ --speed 0 --concurrency 64
+
+A trace is a JSON lines file of {"time", "author", "name", "channel", "content"}, time
+being seconds since the first message. The live bot records one when the
+message_trace_file dynamic option is set; --generate makes a synthetic one instead.
+--speed scales the trace's pace (0 sends as fast as possible), --concurrency caps
+messages in flight. Each run starts from a copy of --state (or an empty ladder) in a
+temporary directory. After a run the ladder is saved and loaded again; the runs' ladder
+states (before and after reloading) and reply streams must all be identical.'''
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import hashlib
+import argparse
+import tempfile
+
+import ladder_manager_main as main
+from ladder_manager_guilds import LADDER_FILES
+from ladder_manager_fakes import FakeClient, FakeMessage, SYLLABLES
+from ladder_manager_outbound import MessageDispatcher
+from ladder_manager_metrics import METRICS
+from dynamic_options import DYNAMIC_OPTIONS
+
+
+
+def load_trace(path : str) -> [dict]:
+    """Reads a trace, making times relative to its first message (recorded traces hold unix times)."""
+    with open(path) as trace_file:
+        trace = [json.loads(line) for line in trace_file if line.strip()]
+    for event in trace[1:]:
+        event['time'] -= trace[0]['time']
+    if trace:
+        trace[0]['time'] = 0.0
+    return trace
+
+
+def generate_trace(players : int, messages : int, rate : float, channels : int = 3, seed : int = 0) -> [dict]:
+    """Makes up a busy ladder: players challenge, accept, report (sometimes decline),
+    look up stats, records and leaderboards and chat in between. rate is messages per second."""
+    rng = random.Random(seed)
+    symbol = DYNAMIC_OPTIONS['command_symbol']
+    names = {100000 + number: ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) + str(number)
+             for number in range(players)}
+    player_ids = list(names)
+    seen = [] #players who have spoken so far, the only ones the replay's guild has
+    seen_ids = set()
+    idle = set() #seen players not in a challenge
+    chat = ('gg', 'anyone up for a game?', 'brb', 'nice one', 'lol', 'what time is the tournament')
+    challenged = [] #(challenger, challenged) waiting to be accepted
+    accepted = [] #(challenger, challenged) waiting for a report
+    trace = []
+    now = 0.0
+
+    for _ in range(messages):
+        now += rng.expovariate(rate)
+        action = rng.random()
+        author = rng.choice(player_ids)
+        if author not in seen_ids: #a player's first message introduces them
+            seen.append(author)
+            seen_ids.add(author)
+            idle.add(author)
+            content = 'hi'
+        elif action < 0.15 and len(idle) > 1:
+            author, opponent = rng.sample(sorted(idle), 2)
+            idle -= {author, opponent}
+            challenged.append((author, opponent))
+            content = f'{symbol}play <@{opponent}>'
+        elif action < 0.3 and challenged:
+            challenger, author = challenged.pop(rng.randrange(len(challenged)))
+            if rng.random() < 0.9:
+                accepted.append((challenger, author))
+                content = symbol + 'accept'
+            else:
+                idle |= {challenger, author}
+                content = symbol + 'decline'
+        elif action < 0.45 and accepted:
+            author, opponent = accepted.pop(rng.randrange(len(accepted)))
+            idle |= {author, opponent}
+            content = symbol + 'report ' + ', '.join(f'{rng.choice(("win", "loss"))} {rng.randint(1, 3)}'
+                                                      for _ in range(rng.randint(1, 3)))
+        elif action < 0.55:
+            content = symbol + rng.choice(('leaderboard', 'full_leaderboard', f'full_leaderboard {rng.randint(1, 5)}'))
+        elif action < 0.7:
+            content = symbol + rng.choice(('stats', 'record', f'stats <@{rng.choice(seen)}>',
+                                           f'stats {names[rng.choice(seen)]}', f'record <@{rng.choice(seen)}>'))
+        elif action < 0.75:
+            content = symbol + rng.choice(('ongoing', 'status', 'help', 'rules'))
+        else:
+            content = rng.choice(chat)
+        trace.append({'time': now, 'author': author, 'name': names[author],
+                      'channel': rng.randint(1, channels), 'content': content})
+    return trace
+
+
+def ladder_state(ladder : 'main.LadderManager') -> dict:
+    """Everything a replay changes, in a form that compares equal between runs."""
+    state = {}
+    for player_stats in (ladder.player_stats, ladder.player_stats_1v1):
+        state[player_stats.name] = sorted(
+            (user_id, player_stats.get(user_id)['rating'], player_stats.get(user_id)['wins'],
+             player_stats.get(user_id)['losses'], sorted((opponent, record['wins'], record['losses'])
+                                                         for opponent, record in player_stats.get_records(user_id).items()))
+            for user_id in player_stats.player_ids())
+        state[player_stats.name + '_archived'] = sorted(player_stats.archived_ids())
+    state['teams'] = sorted((player, str(team)) for player, team in ladder.teams.items())
+    state['challenges'] = sorted((player, challenge.get_challenger_players(), challenge.get_challenged_players(),
+                                  challenge.accepted) for player, challenge in ladder.challenges.items())
+    return state
+
+
+def digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys = True).encode()).hexdigest()[:16]
+
+
+class FakeGateway():
+    """Turns trace events into messages from fake users in one fake guild and feeds them to on_message."""
+    def __init__(self, client : FakeClient):
+        self.client = client
+        self.guild = client.add_guild('replay')
+        self.errors = [] #exceptions raised by on_message, in trace order
+        self._channels = {}
+
+
+    def message(self, event : dict) -> FakeMessage:
+        author = self.client.get_user(event['author'])
+        if author is None:
+            author = self.client.add_user(event['author'], event['name'], self.guild)
+            main.user_index.add(author) #what on_member_join would do
+        if event['channel'] not in self._channels:
+            self._channels[event['channel']] = self.client.add_channel(self.guild, f'channel {event["channel"]}', event['channel'])
+        return FakeMessage(author, event['content'], self._channels[event['channel']])
+
+
+    async def replay(self, trace : [dict], speed : float, concurrency : int) -> float:
+        """Returns the seconds it took to handle every message (replies may still be queued)."""
+        loop = asyncio.get_event_loop()
+        in_flight = asyncio.Semaphore(concurrency)
+        handlers = []
+        start = loop.time()
+
+        async def deliver(message):
+            try:
+                await main.on_message(message)
+            except Exception as e: #discord.py logs exceptions raised by events and carries on
+                self.errors.append(f'{message.content!r}: {e!r}')
+            finally:
+                in_flight.release()
+
+        for event in trace:
+            if speed:
+                delay = start + event['time'] / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await in_flight.acquire()
+            handlers.append(asyncio.ensure_future(deliver(self.message(event))))
+        await asyncio.gather(*handlers)
+        return loop.time() - start
+
+
+def run_once(trace : [dict], state_directory : str, speed : float, concurrency : int, channel_rate : float, seed : int) -> dict:
+    """Replays trace on a copy of state_directory in a temporary directory, returns digests and timings."""
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            random.seed(seed) #antis
+            client = FakeClient()
+            gateway = FakeGateway(client)
+            for user_id, name in sorted({(event['author'], event['name']) for event in trace}):
+                client.add_user(user_id, name, gateway.guild)
+            ladders = main.setup(client)
+            os.makedirs(ladders.directory_of(gateway.guild.id))
+            for file_name in LADDER_FILES: #replayed as the fake guild's ladder
+                if state_directory and os.path.exists(os.path.join(state_directory, file_name)):
+                    shutil.copy(os.path.join(state_directory, file_name), ladders.directory_of(gateway.guild.id))
+            main.user_index.rebuild()
+            ladder = ladders.get(gateway.guild.id)
+            main.dispatcher = MessageDispatcher(DYNAMIC_OPTIONS['coalesce_window'],
+                                                channel_rate or DYNAMIC_OPTIONS['channel_messages_per_second'],
+                                                DYNAMIC_OPTIONS['channel_message_burst'])
+
+            loop = asyncio.get_event_loop()
+            start = time.perf_counter()
+            handled = loop.run_until_complete(gateway.replay(trace, speed, concurrency))
+            loop.run_until_complete(main.dispatcher.join())
+            elapsed = time.perf_counter() - start
+
+            state = ladder_state(ladder)
+            ladders.close()
+            ladders = main.setup(client)
+            reloaded = ladder_state(ladders.get(gateway.guild.id))
+            ladders.close()
+        finally:
+            os.chdir(cwd)
+
+    replies = {} #channel id: reply lines, coalescing only changes how lines are grouped into messages
+    for channel, text in client.sent:
+        replies.setdefault(channel, []).extend(text.split('\n'))
+    return {'handled': handled,
+            'elapsed': elapsed,
+            'state': digest(state),
+            'reloaded_state': digest(reloaded),
+            'replies': digest([sorted(replies.items()), gateway.errors]),
+            'reply_messages': len(client.sent),
+            'errors': gateway.errors}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Replay chat messages through on_message offline.')
+    source = parser.add_mutually_exclusive_group(required = True)
+    source.add_argument('--trace', help = 'JSON lines trace to replay')
+    source.add_argument('--generate', type = int, metavar = 'MESSAGES', help = 'replay a generated trace of this many messages')
+    parser.add_argument('--players', type = int, default = 500, help = 'players in a generated trace')
+    parser.add_argument('--rate', type = float, default = 5, help = 'messages per second in a generated trace')
+    parser.add_argument('--state', help = 'directory with ladder files to start from (default: empty ladder)')
+    parser.add_argument('--speed', type = float, default = 1, help = 'multiple of the trace pace, 0 for as fast as possible')
+    parser.add_argument('--concurrency', type = int, default = 16, help = 'most messages handled at once')
+    parser.add_argument('--channel-rate', type = float, help = 'override channel_messages_per_second')
+    parser.add_argument('--runs', type = int, default = 2, help = 'replays to compare for determinism')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--save-trace', help = 'write the generated trace here')
+    args = parser.parse_args()
+
+    DYNAMIC_OPTIONS['metrics_file'] = ''
+    DYNAMIC_OPTIONS['message_trace_file'] = ''
+    trace = load_trace(args.trace) if args.trace else generate_trace(args.players, args.generate, args.rate, seed = args.seed)
+    if args.save_trace:
+        with open(args.save_trace, 'w') as trace_file:
+            trace_file.writelines(json.dumps(event) + '\n' for event in trace)
+    state_directory = os.path.abspath(args.state) if args.state else None
+
+    results = []
+    for run in range(args.runs):
+        result = run_once(trace, state_directory, args.speed, args.concurrency, args.channel_rate, args.seed)
+        results.append(result)
+        print(f'run {run + 1}: {len(trace)} messages handled in {result["handled"]:.2f}s '
+              f'({len(trace) / result["handled"]:.0f}/s), {result["reply_messages"]} replies sent after {result["elapsed"]:.2f}s, '
+              f'{len(result["errors"])} errors, state {result["state"]}, reloaded {result["reloaded_state"]}, replies {result["replies"]}')
+        for error in result['errors'][:10]:
+            print('    ' + error)
+    print(METRICS.summary())
+
+    problems = [f'run {run + 1} state changed when saved and reloaded' for run, result in enumerate(results)
+                if result['state'] != result['reloaded_state']]
+    problems += [f'run {run + 1} {key} differs from run 1' for run, result in enumerate(results[1:], 1)
+                 for key in ('state', 'replies') if result[key] != results[0][key]]
+    for problem in problems:
+        print(problem)
+    print('deterministic' if not problems else 'NOT deterministic')
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,521 @@
+import os
+import sys
+import asyncio
+import sqlite3
+from abc import ABC, abstractmethod
+
+from ladder_manager_journal import MatchJournal
+from ladder_manager_ranking import RankIndex
+from ladder_manager_records import HeadToHead, pair_key
+
+LADDERS = ('general', '1v1')
+
+
+class PlayerStatsRepository(ABC):
+    """Interface the commands use to read and change one ladder's player stats.
+        Archived players (no longer found on any server) keep their stats but are
+        hidden from everything except archived_ids and restore."""
+    @abstractmethod
+    def has_account(self, user_id : int) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_account(self, user_id : int, rating : int) -> None:
+        """Creates an account (or restores an archived one) if the player has none."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, user_id : int) -> dict:
+        """Returns {'rating': int, 'wins': int, 'losses': int} or None, treat it as read only."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def count(self) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def player_ids(self) -> [int]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def top(self, count : int, start : int = 0) -> [(int, int)]:
+        """Returns (user_id, rating) for count players from place start + 1 down."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def rank(self, user_id : int) -> int:
+        """Returns a player's 1-based place on the leaderboard."""
+        raise NotImplementedError
+
+    @property
+    def version(self) -> int:
+        """Changes whenever a rating changes or a player joins/leaves the leaderboard."""
+        return self._rank_index.version
+
+    @abstractmethod
+    def update_stats(self, user_id : int, mmr_delta : int, wins : int, losses : int) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_records(self, user_id : int) -> {int: dict}:
+        """Returns {opponent_id: {'wins': int, 'losses': int}} for a player."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_record(self, user_id : int, opponent : int) -> dict:
+        """Returns {'wins': int, 'losses': int} of user_id against opponent, or None if they never played."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_record(self, user_id : int, opponent : int, wins : int, losses : int) -> None:
+        """Adds a result of user_id against opponent to their head-to-head record (both need accounts).
+            The record is kept once for the pair, so call it once per pair of players."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def archived_ids(self) -> [int]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def is_archived(self, user_id : int) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def archive(self, user_id : int) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def restore(self, user_id : int) -> None:
+        raise NotImplementedError
+
+
+class PlayerStats():
+    """One account of an in-memory ladder.
+        records only holds head-to-head records of snapshots written before they moved to
+        the ladder's HeadToHead store; they're moved there on load and records becomes None.
+        Supports stats['rating'] style reads so code written for the old account dicts keeps working."""
+    __slots__ = ('rating', 'wins', 'losses', 'records')
+
+    def __init__(self, rating : int, wins : int = 0, losses : int = 0, records : dict = None):
+        self.rating = rating
+        self.wins = wins
+        self.losses = losses
+        self.records = records
+
+    def __getitem__(self, key : str):
+        return getattr(self, key)
+
+    def __reduce__(self):
+        return (PlayerStats, (self.rating, self.wins, self.losses))
+
+    @classmethod
+    def from_dict(cls, stats : dict) -> 'PlayerStats':
+        """Converts an account dict (the format of snapshots written by older versions)."""
+        return cls(stats['rating'], stats['wins'], stats['losses'], stats.get('records'))
+
+
+def _legacy_record(record : 'dict or int') -> (int, int):
+    """(wins, losses) of a per-account record: a {'wins', 'losses'} dict or wins << 32 | losses."""
+    if isinstance(record, int):
+        return record >> 32, record & 0xFFFFFFFF
+    return record['wins'], record['losses']
+
+
+def _pairs_from_legacy_records(accounts : [dict]) -> {int: int}:
+    """Builds HeadToHead pairs from records kept per account (each pair stored on both sides).
+        Both sides held the same result mirrored, the lower id's side wins if they disagree."""
+    pairs = {}
+    for lower_side in (False, True):
+        for player_stats in accounts:
+            for user_id, stats in player_stats.items():
+                for opponent, record in (stats.records or {}).items():
+                    if (user_id < opponent) == lower_side and user_id != opponent:
+                        wins, losses = _legacy_record(record)
+                        pairs[pair_key(user_id, opponent)] = wins << 32 | losses if lower_side else losses << 32 | wins
+    for player_stats in accounts:
+        for stats in player_stats.values():
+            stats.records = None
+    return pairs
+
+
+class MemoryPlayerStatsRepository(PlayerStatsRepository):
+    """Keeps a ladder in {user_id: PlayerStats} dictionaries (see ladder_manager_main) and
+        a HeadToHead store. Snapshots from older versions (account dicts, records kept
+        per account) are converted as they're loaded."""
+    def __init__(self, name : str, player_stats : dict, archived_player_stats : dict, head_to_head_pairs : dict = None):
+        self.name = name
+        self.player_stats = player_stats
+        self.archived_player_stats = archived_player_stats
+        for accounts in (player_stats, archived_player_stats):
+            for user_id, stats in accounts.items():
+                if not isinstance(stats, PlayerStats):
+                    accounts[user_id] = PlayerStats.from_dict(stats)
+        if head_to_head_pairs is None:
+            head_to_head_pairs = _pairs_from_legacy_records([player_stats, archived_player_stats])
+        self.head_to_head = HeadToHead(head_to_head_pairs)
+        self._rank_index = RankIndex((user_id, stats.rating) for user_id, stats in player_stats.items())
+
+    def has_account(self, user_id : int) -> bool:
+        return user_id in self.player_stats
+
+    def create_account(self, user_id : int, rating : int) -> None:
+        if user_id in self.archived_player_stats:
+            self.restore(user_id)
+        elif user_id not in self.player_stats:
+            self.player_stats[user_id] = PlayerStats(rating)
+            self._rank_index.add(user_id, rating)
+
+    def get(self, user_id : int) -> PlayerStats:
+        return self.player_stats.get(user_id)
+
+    def count(self) -> int:
+        return len(self.player_stats)
+
+    def player_ids(self) -> [int]:
+        return list(self.player_stats)
+
+    def top(self, count : int, start : int = 0) -> [(int, int)]:
+        return self._rank_index.top(count, start)
+
+    def rank(self, user_id : int) -> int:
+        return self._rank_index.rank(user_id)
+
+    def update_stats(self, user_id : int, mmr_delta : int, wins : int, losses : int) -> None:
+        stats = self.player_stats[user_id]
+        stats.rating += mmr_delta
+        stats.wins += wins
+        stats.losses += losses
+        if mmr_delta:
+            self._rank_index.add(user_id, stats.rating)
+
+    def set_stats(self, user_id : int, rating : int, wins : int, losses : int) -> None:
+        """Overwrites a player's stats (used when replaying the match journal)."""
+        stats = self.player_stats[user_id]
+        self.update_stats(user_id, rating - stats.rating, wins - stats.wins, losses - stats.losses)
+
+    def get_records(self, user_id : int) -> {int: dict}:
+        if user_id not in self.player_stats:
+            return {}
+        return self.head_to_head.records(user_id)
+
+    def get_record(self, user_id : int, opponent : int) -> dict:
+        record = self.head_to_head.get(user_id, opponent)
+        if record is not None:
+            return {'wins': record[0], 'losses': record[1]}
+
+    def update_record(self, user_id : int, opponent : int, wins : int, losses : int) -> None:
+        if user_id in self.player_stats and opponent in self.player_stats:
+            self.head_to_head.add(user_id, opponent, wins, losses)
+
+    def archived_ids(self) -> [int]:
+        return list(self.archived_player_stats)
+
+    def is_archived(self, user_id : int) -> bool:
+        return user_id in self.archived_player_stats
+
+    def archive(self, user_id : int) -> None:
+        self.archived_player_stats[user_id] = self.player_stats.pop(user_id)
+        self._rank_index.remove(user_id)
+
+    def restore(self, user_id : int) -> None:
+        self.player_stats[user_id] = self.archived_player_stats.pop(user_id)
+        self._rank_index.add(user_id, self.player_stats[user_id].rating)
+
+
+class PickleStorage():
+    """Holds every ladder in memory; persisted as a pickle snapshot plus a match journal."""
+    def __init__(self, snapshot_path : str, journal_path : str, snapshot_interval : int):
+        self.match_journal = MatchJournal(snapshot_path, journal_path, snapshot_interval)
+        stats = [{}, {}, {}, {}, {}, {}] #used if first time
+        try:
+            stats = self.match_journal.load_snapshot()
+            stats += [None] * (6 - len(stats)) #snapshots without head-to-head stores
+        except Exception as e:
+            print(
+f'''Player stats could not be loaded, exception: {e}.
+This should happen first time you run the bot.
+If this is not your first run, try rebooting the bot.
+If the problem persists contact Antis.''')
+        self._ladders = {'general': MemoryPlayerStatsRepository('general', stats[0], stats[1], stats[4]),
+                         '1v1': MemoryPlayerStatsRepository('1v1', stats[2], stats[3], stats[5])}
+
+        journaled_matches = self.match_journal.load_journal()
+        for record in journaled_matches:
+            self._replay_match(record)
+        if journaled_matches or self.match_journal.has_old_journal():
+            self.snapshot()
+
+
+    def ladder(self, name : str) -> MemoryPlayerStatsRepository:
+        return self._ladders[name]
+
+
+    def commit_match(self, player_stats : MemoryPlayerStatsRepository, t1 : [int], t2 : [int],
+                     t1wins : int, t2wins : int) -> None:
+        """Journals a reported match, snapshotting all stats when one is due.
+            Journal records hold the players' resulting stats so replaying them is exact."""
+        self.commit_matches([(player_stats, t1, t2, t1wins, t2wins)])
+
+
+    def commit_matches(self, matches : [(MemoryPlayerStatsRepository, [int], [int], int, int)]) -> None:
+        """Journals several matches as one record, so after a crash either all of them or none are replayed."""
+        records = [{'ladder': player_stats.name,
+                    'teams': [t1, t2],
+                    'wins': [t1wins, t2wins],
+                    'stats': [[player, player_stats.get(player)['rating'], player_stats.get(player)['wins'], player_stats.get(player)['losses']]
+                              for player in t1 + t2]}
+                   for player_stats, t1, t2, t1wins, t2wins in matches]
+        if self.match_journal.append(records[0] if len(records) == 1 else {'matches': records}, len(records)):
+            self.snapshot_in_background()
+
+
+    def _replay_match(self, record : dict) -> None:
+        """Applies a journaled match (or batch of matches) on top of the loaded snapshot."""
+        if 'matches' in record:
+            for match in record['matches']:
+                self._replay_match(match)
+            return
+        player_stats = self._ladders[record['ladder']]
+        for player, rating, wins, losses in record['stats']:
+            player_stats.create_account(player, rating)
+            player_stats.set_stats(player, rating, wins, losses)
+
+        t1, t2 = record['teams']
+        t1wins, t2wins = record['wins']
+        for player in t1:
+            for opponent in t2:
+                player_stats.update_record(player, opponent, t1wins, t2wins)
+
+
+    def snapshot(self) -> None:
+        """Writes a compacted snapshot of all player stats."""
+        self.match_journal.snapshot(self._stats())
+
+
+    def snapshot_in_background(self) -> None:
+        """Like snapshot, but only the pickling happens on the event loop, the write and fsync of
+            a whole ladder run on an executor (synchronous without a running loop, eg. offline tools)."""
+        loop = asyncio.get_event_loop()
+        if not loop.is_running():
+            self.snapshot()
+            return
+        write = self.match_journal.snapshot_later(self._stats())
+        if write is not None:
+            loop.run_in_executor(None, write)
+
+
+    def _stats(self) -> list:
+        general, one_v_one = self._ladders['general'], self._ladders['1v1']
+        return [general.player_stats, general.archived_player_stats,
+                one_v_one.player_stats, one_v_one.archived_player_stats,
+                general.head_to_head.pairs, one_v_one.head_to_head.pairs]
+
+
+    def close(self) -> None:
+        self.snapshot()
+
+
+class SqlitePlayerStatsRepository(PlayerStatsRepository):
+    """Keeps a ladder in a sqlite database so its accounts and records are never loaded into memory whole.
+        Writes are committed by SqliteStorage.commit_match(es), so a report lands atomically.
+        The leaderboard order is the exception: every non-archived (user_id, rating) is read into a
+        RankIndex when the ladder opens, about 220 bytes per player (~22 MB for 100k players), so that
+        rank and top are O(log n) / O(k) instead of an O(rank) COUNT over the rating index per lookup."""
+    def __init__(self, name : str, connection : sqlite3.Connection):
+        self.name = name
+        self._db = connection
+        self.reindex()
+
+    def reindex(self) -> None:
+        """(Re)builds the rank index from the database, needed after players are written behind its back (imports)."""
+        self._rank_index = RankIndex(self._db.execute('SELECT user_id, rating FROM players WHERE ladder = ? AND NOT archived',
+                                                      (self.name,)))
+
+    def has_account(self, user_id : int) -> bool:
+        return self._db.execute('SELECT 1 FROM players WHERE ladder = ? AND user_id = ? AND NOT archived',
+                                (self.name, user_id)).fetchone() is not None
+
+    def create_account(self, user_id : int, rating : int) -> None:
+        self._db.execute('INSERT OR IGNORE INTO players (ladder, user_id, rating) VALUES (?, ?, ?)',
+                         (self.name, user_id, rating))
+        self._db.execute('UPDATE players SET archived = 0 WHERE ladder = ? AND user_id = ? AND archived',
+                         (self.name, user_id))
+        if user_id not in self._rank_index:
+            self._rank_index.add(user_id, self.get(user_id)['rating'])
+
+    def get(self, user_id : int) -> dict:
+        row = self._db.execute('SELECT rating, wins, losses FROM players WHERE ladder = ? AND user_id = ? AND NOT archived',
+                               (self.name, user_id)).fetchone()
+        if row:
+            return {'rating': row[0], 'wins': row[1], 'losses': row[2]}
+
+    def count(self) -> int:
+        return len(self._rank_index)
+
+    def player_ids(self) -> [int]:
+        return [row[0] for row in self._db.execute('SELECT user_id FROM players WHERE ladder = ? AND NOT archived',
+                                                   (self.name,))]
+
+    def top(self, count : int, start : int = 0) -> [(int, int)]:
+        return self._rank_index.top(count, start)
+
+    def rank(self, user_id : int) -> int:
+        return self._rank_index.rank(user_id)
+
+    def update_stats(self, user_id : int, mmr_delta : int, wins : int, losses : int) -> None:
+        self._db.execute('UPDATE players SET rating = rating + ?, wins = wins + ?, losses = losses + ? WHERE ladder = ? AND user_id = ?',
+                         (mmr_delta, wins, losses, self.name, user_id))
+        if mmr_delta:
+            self._rank_index.add(user_id, self.get(user_id)['rating'])
+
+    def get_records(self, user_id : int) -> {int: dict}:
+        return {opponent: {'wins': wins, 'losses': losses} for opponent, wins, losses in
+                self._db.execute('''SELECT high_id, low_wins, high_wins FROM head_to_head WHERE ladder = ? AND low_id = ?
+                                    UNION ALL
+                                    SELECT low_id, high_wins, low_wins FROM head_to_head WHERE ladder = ? AND high_id = ?''',
+                                 (self.name, user_id, self.name, user_id))}
+
+    def get_record(self, user_id : int, opponent : int) -> dict:
+        row = self._db.execute('SELECT low_wins, high_wins FROM head_to_head WHERE ladder = ? AND low_id = ? AND high_id = ?',
+                               (self.name, min(user_id, opponent), max(user_id, opponent))).fetchone()
+        if row:
+            wins, losses = row if user_id < opponent else reversed(row)
+            return {'wins': wins, 'losses': losses}
+
+    def update_record(self, user_id : int, opponent : int, wins : int, losses : int) -> None:
+        if user_id == opponent or not (self.has_account(user_id) and self.has_account(opponent)):
+            return
+        if user_id > opponent:
+            user_id, opponent, wins, losses = opponent, user_id, losses, wins
+        self._db.execute('INSERT OR IGNORE INTO head_to_head (ladder, low_id, high_id) VALUES (?, ?, ?)',
+                         (self.name, user_id, opponent))
+        self._db.execute('UPDATE head_to_head SET low_wins = low_wins + ?, high_wins = high_wins + ? WHERE ladder = ? AND low_id = ? AND high_id = ?',
+                         (wins, losses, self.name, user_id, opponent))
+
+    def archived_ids(self) -> [int]:
+        return [row[0] for row in self._db.execute('SELECT user_id FROM players WHERE ladder = ? AND archived',
+                                                   (self.name,))]
+
+    def is_archived(self, user_id : int) -> bool:
+        return self._db.execute('SELECT 1 FROM players WHERE ladder = ? AND user_id = ? AND archived',
+                                (self.name, user_id)).fetchone() is not None
+
+    def archive(self, user_id : int) -> None:
+        with self._db:
+            self._db.execute('UPDATE players SET archived = 1 WHERE ladder = ? AND user_id = ?', (self.name, user_id))
+        self._rank_index.remove(user_id)
+
+    def restore(self, user_id : int) -> None:
+        with self._db:
+            self._db.execute('UPDATE players SET archived = 0 WHERE ladder = ? AND user_id = ?', (self.name, user_id))
+        self._rank_index.add(user_id, self.get(user_id)['rating'])
+
+
+class SqliteStorage():
+    """Holds every ladder in one sqlite database (WAL mode)."""
+    _schema = '''
+CREATE TABLE IF NOT EXISTS players (
+    ladder TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    rating INTEGER NOT NULL,
+    wins INTEGER NOT NULL DEFAULT 0,
+    losses INTEGER NOT NULL DEFAULT 0,
+    archived INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (ladder, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS players_by_rating ON players (ladder, archived, rating);
+CREATE TABLE IF NOT EXISTS head_to_head (
+    ladder TEXT NOT NULL,
+    low_id INTEGER NOT NULL,
+    high_id INTEGER NOT NULL,
+    low_wins INTEGER NOT NULL DEFAULT 0,
+    high_wins INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (ladder, low_id, high_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS head_to_head_by_high_id ON head_to_head (ladder, high_id);
+'''
+    def __init__(self, database_path : str):
+        self._db = sqlite3.connect(database_path, check_same_thread = False) #closed off the loop when its ladder is unloaded
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.execute('PRAGMA synchronous = FULL') #a committed report survives power loss, like the journal and history
+        self._db.executescript(self._schema)
+        self._migrate_records()
+        self._ladders = {name: SqlitePlayerStatsRepository(name, self._db) for name in LADDERS}
+
+
+    def ladder(self, name : str) -> SqlitePlayerStatsRepository:
+        return self._ladders[name]
+
+
+    def _migrate_records(self) -> None:
+        """Moves records kept once per player (databases made before head_to_head) into head_to_head."""
+        if self._db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'records'").fetchone() is None:
+            return
+        with self._db:
+            self._db.execute('''INSERT OR REPLACE INTO head_to_head
+                                SELECT ladder, opponent_id, user_id, losses, wins FROM records WHERE user_id > opponent_id''')
+            self._db.execute('''INSERT OR REPLACE INTO head_to_head
+                                SELECT ladder, user_id, opponent_id, wins, losses FROM records WHERE user_id < opponent_id''')
+            self._db.execute('DROP TABLE records')
+
+
+    def is_empty(self) -> bool:
+        return self._db.execute('SELECT 1 FROM players LIMIT 1').fetchone() is None
+
+
+    def commit_match(self, player_stats : SqlitePlayerStatsRepository, t1 : [int], t2 : [int],
+                     t1wins : int, t2wins : int) -> None:
+        self._db.commit()
+
+
+    def commit_matches(self, matches : [(SqlitePlayerStatsRepository, [int], [int], int, int)]) -> None:
+        """Every change since the last commit is one transaction, so this is one commit too."""
+        self._db.commit()
+
+
+    def import_pickle_storage(self, storage : PickleStorage) -> None:
+        """Copies every ladder (archived players included) out of a PickleStorage."""
+        with self._db:
+            for name in LADDERS:
+                ladder = storage.ladder(name)
+                for player_stats, archived in ((ladder.player_stats, 0), (ladder.archived_player_stats, 1)):
+                    self._db.executemany('INSERT OR REPLACE INTO players VALUES (?, ?, ?, ?, ?, ?)',
+                                         ((name, user_id, stats.rating, stats.wins, stats.losses, archived)
+                                          for user_id, stats in player_stats.items()))
+                self._db.executemany('INSERT OR REPLACE INTO head_to_head VALUES (?, ?, ?, ?, ?)',
+                                     ((name, key >> 64, key & 0xFFFFFFFFFFFFFFFF, value >> 32, value & 0xFFFFFFFF)
+                                      for key, value in ladder.head_to_head.pairs.items()))
+        for ladder in self._ladders.values():
+            ladder.reindex()
+
+
+    def close(self) -> None:
+        self._db.commit()
+        self._db.close()
+
+
+def open_storage(dynamic_options : dict, snapshot_path : str = 'laddermanager.pkl',
+                 journal_path : str = 'laddermanager_journal.log', database_path : str = 'laddermanager.db'):
+    """Opens the storage backend chosen by the storage_backend dynamic option.
+        A fresh sqlite database is seeded from an existing pickle snapshot and journal."""
+    if dynamic_options['storage_backend'] == 'sqlite':
+        storage = SqliteStorage(database_path)
+        if storage.is_empty() and os.path.exists(snapshot_path):
+            migrate_pickle_to_sqlite(snapshot_path, journal_path, storage)
+        return storage
+    return PickleStorage(snapshot_path, journal_path, dynamic_options['snapshot_interval'])
+
+
+def migrate_pickle_to_sqlite(snapshot_path : str, journal_path : str, storage : SqliteStorage) -> None:
+    """Imports laddermanager.pkl (and any journaled matches on top of it) into storage."""
+    storage.import_pickle_storage(PickleStorage(snapshot_path, journal_path, sys.maxsize))
+
+
+if __name__ == '__main__':
+    #usage: python ladder_manager_storage.py [laddermanager.pkl] [laddermanager.db]
+    snapshot_path = sys.argv[1] if len(sys.argv) > 1 else 'laddermanager.pkl'
+    database_path = sys.argv[2] if len(sys.argv) > 2 else 'laddermanager.db'
+    storage = SqliteStorage(database_path)
+    migrate_pickle_to_sqlite(snapshot_path, 'laddermanager_journal.log', storage)
+    storage.close()
+    print(f'Imported {snapshot_path} into {database_path}.')
@@ -0,0 +1,109 @@
+'''Offline tool: replays the match history with other rating options to see how well each
+would have predicted results, without touching the live ladder.
+
+    python ladder_manager_sweep.py --base-rating-change 15 25 40 --prediction-difference 10 25 50
+
+Each option takes any number of values (defaults are the current DYNAMIC_OPTIONS) and every
+combination is replayed, spread over a process pool that uses every core by default.
+A match counts as predicted correctly if the team rated higher before it won more games.
+
+--history takes history files or ladder folders (ladders/<guild id>/), by default the bot's own
+folder and every guild's. Each history is replayed with its own ratings, guilds don't share players.'''
+import os
+import glob
+import argparse
+import itertools
+from multiprocessing import Pool
+
+import ladder_manager_base as base
+from ladder_manager_history import MatchHistory, HistoricMatch
+from dynamic_options import DYNAMIC_OPTIONS
+
+HISTORY_FILE = 'laddermanager_history.bin'
+
+_histories = None #histories of the worker process, loaded once by _load_histories
+
+
+def history_paths(paths : [str]) -> [str]:
+    """Turns ladder folders into the history file inside them, leaving out folders without one."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            path = os.path.join(path, HISTORY_FILE)
+            if not os.path.exists(path):
+                continue
+        files.append(path)
+    return files
+
+
+def _load_histories(paths : [str]) -> None:
+    global _histories
+    _histories = []
+    for path in paths:
+        history = MatchHistory(path, read_only = True) #the bot may be appending to it
+        _histories.append([history.match(index) for index in range(len(history))])
+
+
+def replay(histories : [['HistoricMatch']], base_rating_change : int, prediction_difference : int,
+           starting_rating : int) -> dict:
+    """Replays each history like report_challenge_option would and scores the predictions made along the way."""
+    predicted = decided = games_predicted = games = 0
+    for matches in histories:
+        ratings = {} #ladder: {user_id: rating}, every history starts over
+        for match in matches:
+            ladder_ratings = ratings.setdefault(match.ladder, {})
+            t1mmr = sum(ladder_ratings.get(player, starting_rating) for player in match.team1)//len(match.team1)
+            t2mmr = sum(ladder_ratings.get(player, starting_rating) for player in match.team2)//len(match.team2)
+
+            new_t1mmr, new_t2mmr, t1wins, t2wins = base.mmr_calculator(base_rating_change, prediction_difference,
+                                                                         t1mmr, t2mmr, match.sets)
+            favored_wins, underdog_wins = (t1wins, t2wins) if t1mmr >= t2mmr else (t2wins, t1wins)
+            if t1wins != t2wins and t1mmr != t2mmr:
+                decided += 1
+                predicted += favored_wins > underdog_wins
+            if t1mmr != t2mmr:
+                games += t1wins + t2wins
+                games_predicted += favored_wins
+
+            for team, delta in ((match.team1, new_t1mmr - t1mmr), (match.team2, new_t2mmr - t2mmr)):
+                for player in team:
+                    ladder_ratings[player] = ladder_ratings.get(player, starting_rating) + delta
+
+    return {'base_rating_change': base_rating_change,
+            'prediction_difference': prediction_difference,
+            'starting_rating': starting_rating,
+            'match_accuracy': predicted/decided if decided else 0.0,
+            'game_accuracy': games_predicted/games if games else 0.0,
+            'predictions': decided}
+
+
+def _replay_options(options : (int, int, int)) -> dict:
+    return replay(_histories, *options)
+
+
+def sweep(paths : [str], option_combinations : [(int, int, int)], workers : int = None) -> [dict]:
+    """Replays the histories once per (base_rating_change, prediction_difference, starting_rating),
+    best match_accuracy first."""
+    with Pool(workers, initializer = _load_histories, initargs = (paths,)) as pool:
+        results = pool.map(_replay_options, option_combinations)
+    return sorted(results, key = lambda result: (result['match_accuracy'], result['game_accuracy']), reverse = True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Replay the match history with other rating options.')
+    parser.add_argument('--history', nargs = '+', default = ['.'] + sorted(glob.glob(os.path.join(DYNAMIC_OPTIONS['ladders_directory'], '*'))),
+                        help = 'history files or ladder folders (default: this folder and every guild\'s ladder folder)')
+    parser.add_argument('--base-rating-change', type = int, nargs = '+', default = [DYNAMIC_OPTIONS['base_rating_change']])
+    parser.add_argument('--prediction-difference', type = int, nargs = '+', default = [DYNAMIC_OPTIONS['prediction_difference']])
+    parser.add_argument('--starting-rating', type = int, nargs = '+', default = [DYNAMIC_OPTIONS['starting_rating']])
+    parser.add_argument('--workers', type = int, default = None, help = 'processes to use (default: every core)')
+    args = parser.parse_args()
+    histories = history_paths(args.history)
+    if not histories:
+        parser.error('no match history found in ' + ', '.join(args.history))
+
+    combinations = list(itertools.product(args.base_rating_change, args.prediction_difference, args.starting_rating))
+    print(f'{"base change":>12}{"prediction diff":>17}{"starting":>10}{"match acc":>11}{"game acc":>10}{"predictions":>13}')
+    for result in sweep(histories, combinations, args.workers):
+        print('{base_rating_change:>12}{prediction_difference:>17}{starting_rating:>10}'
+              '{match_accuracy:>11.2%}{game_accuracy:>10.2%}{predictions:>13}'.format(**result))
@@ -0,0 +1,134 @@
+import bisect
+import difflib
+
+import discord
+
+FUZZY_CANDIDATE_LIMIT = 500 #most names difflib compares against for one fuzzy lookup
+
+
+class UserIndex():
+    """Keeps discord users reachable by id and by name so lookups don't scan client.users.
+        Kept current by the member join/leave/update events in ladder_manager_main."""
+    def __init__(self, client : 'discord.Client()'):
+        self.client = client
+        self._users = {}
+        self._names = {} #casefolded name: {user_id: user}
+        self._sorted_names = [] #keys of self._names, sorted for prefix searches
+        self._indexed_names = {} #user_id: name the user is indexed under (discord renames users in place)
+
+
+    def rebuild(self) -> None:
+        """Indexes every user the client can currently see (called on_ready)."""
+        self._users = {}
+        self._names = {}
+        self._indexed_names = {}
+        for user in self.client.users:
+            self._users[user.id] = user
+            self._indexed_names[user.id] = user.name.casefold()
+            self._names.setdefault(user.name.casefold(), {})[user.id] = user
+        self._sorted_names = sorted(self._names)
+
+
+    def add(self, user : discord.User) -> None:
+        self._remove_name(user.id)
+        self._users[user.id] = user
+        self._add_name(user)
+
+
+    def remove(self, user_id : int) -> bool:
+        """Drops a user, but only once they share no guild with the bot anymore.
+            Returns whether the user was dropped."""
+        for guild in self.client.guilds:
+            if guild.get_member(user_id) is not None:
+                return False
+        self._users.pop(user_id, None)
+        self._remove_name(user_id)
+        return True
+
+
+    def get(self, user_id : int) -> discord.User:
+        """Returns the user with the given id, or None if they can't be found.
+            Ids the index hasn't seen yet (eg. events missed while reconnecting)
+            fall back to the client's own cache and are indexed if found there."""
+        user = self._users.get(user_id)
+        if user is None:
+            user = self.client.get_user(user_id)
+            if user is not None:
+                self.add(user)
+        return user
+
+
+    def get_many(self, user_ids : [int]) -> {int: discord.User}:
+        """Resolves many ids in one pass, leaving out the users that can't be found."""
+        users = {}
+        indexed = self._users
+        for user_id in user_ids:
+            user = indexed.get(user_id) or self.get(user_id)
+            if user is not None:
+                users[user_id] = user
+        return users
+
+
+    def find_by_name(self, name : str) -> [discord.User]:
+        """Returns every user whose name matches exactly (ignoring case)."""
+        return list(self._names.get(name.casefold(), {}).values())
+
+
+    def find_by_prefix(self, prefix : str, limit : int = 25) -> [discord.User]:
+        """Returns up to limit users whose names start with prefix (ignoring case)."""
+        users = []
+        for name in self._names_with_prefix(prefix.casefold(), limit):
+            users.extend(self._names[name].values())
+        return users[:limit]
+
+
+    def find_fuzzy(self, name : str) -> discord.User:
+        """Returns the single user best matching name, or None if there's no clear match.
+            Tries an exact match, then a unique prefix, then (if nothing starts with name)
+            close spellings among names sharing the first two letters so the search stays bounded."""
+        name = name.casefold()
+        if name in self._names:
+            return self._unique(self._names[name])
+
+        prefixed = self._names_with_prefix(name, 2)
+        if prefixed:
+            return self._unique(self._names[prefixed[0]]) if len(prefixed) == 1 else None
+
+        candidates = self._names_with_prefix(name[:2], FUZZY_CANDIDATE_LIMIT)
+        close = difflib.get_close_matches(name, candidates, n = 2, cutoff = 0.75)
+        if len(close) == 1:
+            return self._unique(self._names[close[0]])
+
+
+    def _names_with_prefix(self, prefix : str, limit : int) -> [str]:
+        start = bisect.bisect_left(self._sorted_names, prefix)
+        names = []
+        for name in self._sorted_names[start:start + limit]:
+            if not name.startswith(prefix):
+                break
+            names.append(name)
+        return names
+
+
+    def _unique(self, users : dict) -> discord.User:
+        return next(iter(users.values())) if len(users) == 1 else None
+
+
+    def _add_name(self, user : discord.User) -> None:
+        name = user.name.casefold()
+        self._indexed_names[user.id] = name
+        if name not in self._names:
+            self._names[name] = {}
+            bisect.insort(self._sorted_names, name)
+        self._names[name][user.id] = user
+
+
+    def _remove_name(self, user_id : int) -> None:
+        name = self._indexed_names.pop(user_id, None)
+        if name is None:
+            return
+        users = self._names[name]
+        del users[user_id]
+        if not users:
+            del self._names[name]
+            del self._sorted_names[bisect.bisect_left(self._sorted_names, name)]